@@ -4,7 +4,28 @@ import sys
 import os
 import random
 import math
-from collections import deque
+import hashlib
+import mmap
+import struct
+import numpy as np
+import threading
+import queue
+import io
+import time
+import contextlib
+import heapq
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque, OrderedDict
+
+# Headless mode: no real window, for driving the playtest simulation from code
+# with step(). On when asked for (MFB_HEADLESS=1, --headless or --batch) or when
+# this file is loaded as a module rather than run
+HEADLESS = (os.environ.get("MFB_HEADLESS") == "1" or "--headless" in sys.argv or "--batch" in sys.argv
+            or __name__ != "__main__")
+if HEADLESS:
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    os.environ["SDL_AUDIODRIVER"] = "dummy"
 
 pygame.init()
 
@@ -82,221 +103,1183 @@ SKID_DECEL = 0.8
 AIR_CONTROL = 0.4
 GROUND_FRICTION = 0.15
 
-# Classes for various game elements
-class Tile(pygame.sprite.Sprite):
-    def __init__(self, pos, tile_type):
-        super().__init__()
-        self.tile_type = tile_type
-        self.image = pygame.Surface((GRID_SIZE, GRID_SIZE))
-        self.rect = self.image.get_rect(topleft=pos)
-        self.update_image()
-        
-        # Additional properties for Mario Fan Builder features
-        self.is_solid = tile_type in ['ground', 'brick', 'question', 'pipe']
-        self.is_platform = tile_type == 'platform'
-        self.is_breakable = tile_type == 'brick'
-        self.contains_item = None
-        
-        if tile_type == 'question':
-            self.contains_item = 'coin'  # Default, can be changed
+# Per-character factors on jump strength and gravity; FLOAT_GRAVITY replaces
+# the gravity factor while jump is held in the air
+CHARACTER_JUMP = {'luigi': 1.1, 'toad': 0.9}
+CHARACTER_GRAVITY = {'luigi': 0.9, 'peach': 0.7}
+FLOAT_GRAVITY = {'peach': 0.3}
+
+# Tile map: the level's tiles as one byte per grid cell (an index into
+# TILE_KINDS, 0 = empty), row by row in a flat array that grows as tiles are
+# placed further out. What little a tile carries beyond its kind, question
+# block contents, sits in a side table keyed by cell. occupied mirrors the
+# solid cells for vectorized lookups. Tiles sit on grid cells: one placed off
+# the grid lands in the cell holding its top-left corner, and the map starts at
+# cell (0, 0).
+# For collision, runs of solid cells are merged into as few rectangles as the
+# greedy pass below finds, within square blocks of MERGE_CELLS cells. An edit
+# only marks its block; the block is merged again the next time a query
+# touches it
+MERGE_CELLS = 32
+TILE_KINDS = [None, 'ground', 'brick', 'question', 'pipe', 'platform', 'water']
+SOLID_TILE_TYPES = ['ground', 'brick', 'question', 'pipe']
+TILE_IDS = {kind: tile_id for tile_id, kind in enumerate(TILE_KINDS) if kind}
+SOLID_IDS = np.array([kind in SOLID_TILE_TYPES for kind in TILE_KINDS])
+
+class TileMap:
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cols = 0
+        self.rows = 0
+        self.ids = np.zeros(0, np.uint8)
+        self.occupied = np.zeros(0, bool)
+        self.items = {}  # (col, row) -> what a question block gives out
+        self.count = 0
+        self.skipped = 0  # Tiles set left of or above the map, which it can't hold
+        self._reset_colliders()
+
+    def _reset_colliders(self):
+        self.collider_ids = np.full(len(self.ids), -1, np.int32)  # Per cell, the merged rect covering it
+        self.colliders = {}        # id -> Rect
+        self.block_colliders = {}  # (block_x, block_y) -> ids merged in that block
+        self.merged = set()        # Blocks whose colliders are up to date
+        self.next_collider = 0
+
+    def _grow(self, cols, rows):
+        if cols <= self.cols and rows <= self.rows:
+            return
+        new_cols = max(cols, self.cols * 2, 32) if cols > self.cols else self.cols
+        new_rows = max(rows, self.rows * 2, 16) if rows > self.rows else self.rows
+        ids = np.zeros((new_rows, new_cols), np.uint8)
+        ids[:self.rows, :self.cols] = self.ids.reshape(self.rows, self.cols)
+        self.cols, self.rows = new_cols, new_rows
+        self.ids = ids.ravel()
+        self.occupied = SOLID_IDS[self.ids]
+        self._reset_colliders()
+
+    def cell_at(self, pos):
+        return pos[0] // self.cell_size, pos[1] // self.cell_size
+
+    def cell_rect(self, cell):
+        return pygame.Rect(cell[0] * self.cell_size, cell[1] * self.cell_size, self.cell_size, self.cell_size)
+
+    def kind_at(self, cell):
+        col, row = cell
+        if 0 <= col < self.cols and 0 <= row < self.rows:
+            return TILE_KINDS[self.ids[row * self.cols + col]]
+        return None
+
+    def get(self, pos):
+        return self.kind_at(self.cell_at(pos))
+
+    def set(self, pos, kind, contains_item=None):
+        # Returns the cell filled, or None for a position left of or above the map
+        col, row = cell = self.cell_at(pos)
+        if col < 0 or row < 0:
+            self.skipped += 1
+            return None
+        self._grow(col + 1, row + 1)
+        index = row * self.cols + col
+        if not self.ids[index]:
+            self.count += 1
+        self.ids[index] = TILE_IDS[kind]
+        self.occupied[index] = kind in SOLID_TILE_TYPES
+        self.merged.discard((col // MERGE_CELLS, row // MERGE_CELLS))
+        if contains_item is not None:
+            self.items[cell] = contains_item
+        else:
+            self.items.pop(cell, None)
+        return cell
+
+    def remove(self, pos):
+        # Empties the cell; returns the record of the tile that was there
+        cell = self.cell_at(pos)
+        kind = self.kind_at(cell)
+        if kind is None:
+            return None
+        index = cell[1] * self.cols + cell[0]
+        self.ids[index] = 0
+        self.occupied[index] = False
+        self.merged.discard((cell[0] // MERGE_CELLS, cell[1] // MERGE_CELLS))
+        self.count -= 1
+        return self.record(cell, kind, self.items.pop(cell, None))
+
+    def record(self, cell, kind, contains_item):
+        return (kind, cell[0] * self.cell_size, cell[1] * self.cell_size, None, contains_item)
+
+    def _window(self, rect):
+        size = self.cell_size
+        return (max(rect.left // size, 0), min((rect.right - 1) // size + 1, self.cols),
+                max(rect.top // size, 0), min((rect.bottom - 1) // size + 1, self.rows))
+
+    def cells_in(self, rect, kind=None):
+        # (cell, kind) for the tiles inside rect, row by row
+        left, right, top, bottom = self._window(rect)
+        if right <= left or bottom <= top:
+            return []
+        window = self.ids.reshape(self.rows, self.cols)[top:bottom, left:right]
+        mask = window != 0 if kind is None else window == TILE_IDS[kind]
+        rows, cols = np.nonzero(mask)
+        return [((left + col, top + row), TILE_KINDS[tile_id])
+                for row, col, tile_id in zip(rows.tolist(), cols.tolist(), window[rows, cols].tolist())]
+
+    def rects_in(self, rect, kind):
+        return [self.cell_rect(cell) for cell, _ in self.cells_in(rect, kind)]
+
+    def _merge(self, block):
+        # Greedy pass: from the first solid cell not yet covered, row by row,
+        # run right as far as the row goes, then grow down while the whole run
+        # is solid and uncovered
+        for collider in self.block_colliders.pop(block, ()):
+            del self.colliders[collider]
+        self.merged.add(block)
+        left, top = block[0] * MERGE_CELLS, block[1] * MERGE_CELLS
+        width, height = min(MERGE_CELLS, self.cols - left), min(MERGE_CELLS, self.rows - top)
+        if width <= 0 or height <= 0:
+            return
+        ids = self.collider_ids.reshape(self.rows, self.cols)[top:top + height, left:left + width]
+        ids[:] = -1
+        free = self.occupied.reshape(self.rows, self.cols)[top:top + height, left:left + width].tolist()
+        size = self.cell_size
+        made = []
+        for row in range(height):
+            col = 0
+            while col < width:
+                if not free[row][col]:
+                    col += 1
+                    continue
+                end = col + 1
+                while end < width and free[row][end]:
+                    end += 1
+                last = row + 1
+                while last < height and all(free[last][col:end]):
+                    last += 1
+                for covered in free[row:last]:
+                    covered[col:end] = [False] * (end - col)
+                collider = self.next_collider
+                self.next_collider += 1
+                self.colliders[collider] = pygame.Rect((left + col) * size, (top + row) * size,
+                                                       (end - col) * size, (last - row) * size)
+                ids[row:last, col:end] = collider
+                made.append(collider)
+                col = end
+        self.block_colliders[block] = made
+
+    def colliders_in(self, rect):
+        # Merged solid rects that rect overlaps, in the order their cells come
+        # row by row
+        left, right, top, bottom = self._window(rect)
+        if right <= left or bottom <= top:
+            return []
+        for block_y in range(top // MERGE_CELLS, (bottom - 1) // MERGE_CELLS + 1):
+            for block_x in range(left // MERGE_CELLS, (right - 1) // MERGE_CELLS + 1):
+                if (block_x, block_y) not in self.merged:
+                    self._merge((block_x, block_y))
+        found = {}
+        for row in self.collider_ids.reshape(self.rows, self.cols)[top:bottom, left:right].tolist():
+            for collider in row:
+                if collider >= 0:
+                    found[collider] = None
+        return [self.colliders[collider] for collider in found]
+
+    def records_in(self, rect):
+        return [self.record(cell, kind, self.items.get(cell)) for cell, kind in self.cells_in(rect)]
+
+    def records(self):
+        everything = pygame.Rect(0, 0, self.cols * self.cell_size, self.rows * self.cell_size)
+        return self.records_in(everything)
+
+    def bounds(self):
+        # Rect around every tile, or None if there are none
+        if not self.count:
+            return None
+        rows, cols = np.nonzero(self.ids.reshape(self.rows, self.cols))
+        size = self.cell_size
+        return pygame.Rect(cols.min() * size, rows.min() * size,
+                           (cols.max() - cols.min() + 1) * size, (rows.max() - rows.min() + 1) * size)
+
+    def clear_region(self, rect):
+        for cell, _ in self.cells_in(rect):
+            self.remove(self.cell_rect(cell).topleft)
+
+    def clear(self):
+        self.ids[:] = 0
+        self.occupied[:] = False
+        self.items.clear()
+        self.count = 0
+        self.skipped = 0
+        self._reset_colliders()
+
+    def rebuild(self, records, cell_size=None):
+        if cell_size is not None:
+            self.cell_size = cell_size
+        self.cols, self.rows = 0, 0
+        self.ids = np.zeros(0, np.uint8)
+        self.occupied = np.zeros(0, bool)
+        self.items.clear()
+        self.count = 0
+        self._reset_colliders()
+        for tile_type, x, y, variant, contains_item in records:
+            self.set((x, y), tile_type, contains_item)
+
+# Editor occupancy: grid cell -> the entities placed there, filed by the cell
+# under their centre. Walkers are moved along as they cross into another cell,
+# so clicking where an entity is now finds it
+class CellIndex:
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}  # (col, row) -> {sprite: None}, most recently added last
+
+    def cell_at(self, pos):
+        return pos[0] // self.cell_size, pos[1] // self.cell_size
+
+    def add(self, sprite):
+        sprite.cell = self.cell_at(sprite.rect.center)
+        self.cells.setdefault(sprite.cell, {})[sprite] = None
+
+    def remove(self, sprite):
+        sprites = self.cells.get(getattr(sprite, 'cell', None))
+        if sprites is not None:
+            sprites.pop(sprite, None)
+            if not sprites:
+                del self.cells[sprite.cell]
+
+    def move(self, sprite):
+        # Only entities placed in the editor are indexed
+        if sprite.cell is not None and self.cell_at(sprite.rect.center) != sprite.cell:
+            self.remove(sprite)
+            self.add(sprite)
+
+    def get(self, pos):
+        sprites = self.cells.get(self.cell_at(pos))
+        return next(reversed(sprites)) if sprites else None
+
+    def clear(self):
+        self.cells.clear()
+
+    def rebuild(self, sprites, cell_size=None):
+        if cell_size is not None:
+            self.cell_size = cell_size
+        self.cells.clear()
+        for sprite in sprites:
+            if sprite.cell is not None:
+                self.add(sprite)
+
+# Static tile layer: the tile map is baked into fixed-size chunk surfaces.
+# Placing or removing a tile only drops the baked surface of its chunk, which
+# is re-baked the next time that chunk is drawn.
+CHUNK_CELLS = 16
+MAX_BAKED_CHUNKS = 64
+
+class StaticTileLayer:
+    def __init__(self, tile_map, chunk_cells=CHUNK_CELLS, max_baked=MAX_BAKED_CHUNKS):
+        self.tile_map = tile_map
+        self.chunk_cells = chunk_cells
+        self.max_baked = max_baked
+        self.baked = OrderedDict()       # (chunk_x, chunk_y) -> Surface (None if empty), least recently drawn first
+
+    @property
+    def chunk_size(self):
+        return self.tile_map.cell_size * self.chunk_cells
+
+    def invalidate_at(self, pos):
+        self.baked.pop((pos[0] // self.chunk_size, pos[1] // self.chunk_size), None)
+
+    def invalidate(self):
+        self.baked.clear()
+
+    def bake(self, key):
+        size = self.chunk_size
+        origin_x, origin_y = key[0] * size, key[1] * size
+        cell_size = self.tile_map.cell_size
+        tiles = self.tile_map.cells_in(pygame.Rect(origin_x, origin_y, size, size))
+        if not tiles:
+            return None
+        surface = pygame.Surface((size, size), pygame.SRCALPHA)
+        surface.blits([(atlas.get('tile', kind, cell_size),
+                        (col * cell_size - origin_x, row * cell_size - origin_y))
+                       for (col, row), kind in tiles], False)
+        return surface
+
+    def draw(self, surface, view_rect):
+        size = self.chunk_size
+        for chunk_y in range(view_rect.top // size, (view_rect.bottom - 1) // size + 1):
+            for chunk_x in range(view_rect.left // size, (view_rect.right - 1) // size + 1):
+                key = (chunk_x, chunk_y)
+                if key in self.baked:
+                    baked = self.baked[key]
+                    self.baked.move_to_end(key)
+                else:
+                    baked = self.baked[key] = self.bake(key)
+                    if len(self.baked) > self.max_baked:
+                        self.baked.popitem(last=False)
+                if baked is not None:
+                    surface.blit(baked, (chunk_x * size - view_rect.x, chunk_y * size - view_rect.y))
+
+# Sprites drawn one by one (coins, enemies, power-ups) are kept in spatial
+# buckets, so drawing and updating only visit the buckets near the camera no
+# matter how large the level is. Buckets keep insertion order so overlapping
+# sprites draw in the order they were added.
+BUCKET_SIZE = 256
+
+class SpatialBuckets:
+    def __init__(self, bucket_size=BUCKET_SIZE):
+        self.bucket_size = bucket_size
+        self.buckets = {}  # (bucket_x, bucket_y) -> {sprite: None}
+
+    def key_of(self, rect):
+        return rect.centerx // self.bucket_size, rect.centery // self.bucket_size
+
+    def add(self, sprite):
+        sprite.bucket = self.key_of(sprite.rect)
+        self.buckets.setdefault(sprite.bucket, {})[sprite] = None
+
+    def remove(self, sprite):
+        key = getattr(sprite, 'bucket', None)
+        bucket = self.buckets.get(key)
+        if bucket is not None and sprite in bucket:
+            del bucket[sprite]
+            if not bucket:
+                del self.buckets[key]
+
+    def move(self, sprite):
+        if self.key_of(sprite.rect) != sprite.bucket:
+            self.remove(sprite)
+            self.add(sprite)
+
+    def clear(self):
+        self.buckets.clear()
+
+    def rebuild(self, sprites):
+        self.clear()
+        for sprite in sprites:
+            self.add(sprite)
+
+    def query(self, rect):
+        # Sprites are bucketed by centre, so look half a bucket past the rect
+        size = self.bucket_size
+        half = size // 2
+        found = []
+        for bucket_y in range((rect.top - half) // size, (rect.bottom + half) // size + 1):
+            for bucket_x in range((rect.left - half) // size, (rect.right + half) // size + 1):
+                bucket = self.buckets.get((bucket_x, bucket_y))
+                if bucket:
+                    found.extend(bucket)
+        return found
+
+# Camera: the world-space rect shown in the play area. It follows the player in
+# playtest (clamped to the level) and is panned with the arrow keys in the editor
+CAMERA_PAN_SPEED = 10
+ACTIVE_MARGIN = 200  # Enemies and power-ups this far off screen still update
+
+class Camera:
+    def __init__(self, view):
+        self.view = view  # Screen area the world is drawn into
+        self.rect = pygame.Rect(0, 0, view.width, view.height)
+        self.saved = self.rect.topleft
+
+    def to_world(self, pos):
+        return pos[0] - self.view.x + self.rect.x, pos[1] - self.view.y + self.rect.y
+
+    def to_screen(self, rect):
+        return rect.move(self.view.x - self.rect.x, self.view.y - self.rect.y)
+
+    def pan(self, dx, dy):
+        self.rect.x = max(self.rect.x + dx, 0)
+        self.rect.y = max(self.rect.y + dy, 0)
+
+    def follow(self, target, bounds):
+        self.rect.center = target.center
+        self.rect.clamp_ip(bounds)
+
+    def save(self):
+        self.saved = self.rect.topleft
+
+    def restore(self):
+        self.rect.topleft = self.saved
+
+    def active_rect(self):
+        return self.rect.inflate(ACTIVE_MARGIN * 2, ACTIVE_MARGIN * 2)
+
+# Streamed level: the world is split into chunks. Chunks near the camera are
+# live (real sprites); the rest are kept as compact records
+# (tile_type, x, y, variant, extra) and only become sprites when the camera
+# gets close. Live chunks that are no longer wanted are turned back into
+# records, least recently wanted first, once the live entity cap is exceeded.
+# Tiles are never streamed: they go straight into the tile map as they are read.
+STREAM_CHUNK_CELLS = 16
+MAX_LIVE_ENTITIES = 50000  # Memory cap: a live sprite costs far more than its record
+
+class LevelChunks:
+    def __init__(self, cell_size, chunk_cells=STREAM_CHUNK_CELLS, max_live=MAX_LIVE_ENTITIES):
+        self.cell_size = cell_size
+        self.chunk_cells = chunk_cells
+        self.max_live = max_live
+        self.cold = {}             # (chunk_x, chunk_y) -> list of records
+        self.live = OrderedDict()  # (chunk_x, chunk_y) -> {sprite: None}, least recently wanted first
+        self.live_count = 0
+        self.source = None         # MappedLevel read one column strip of chunks at a time
+        self.read_strips = set()
+        self.dirty = set()         # Chunks edited since the last save
+        self.dirty_all = False     # Set when only a full save will do
+        self.quiet = False         # Streaming in or out, which isn't an edit
+        self.edits = 0             # Bumped on every edit, for anything derived from the level
+
+    @property
+    def chunk_size(self):
+        return self.cell_size * self.chunk_cells
+
+    def key_at(self, pos):
+        return pos[0] // self.chunk_size, pos[1] // self.chunk_size
+
+    def store(self, record):
+        if record[0] in TILE_IDS:
+            place_tile(record[1:3], record[0], record[4])
+            return
+        key = self.key_at(record[1:3])
+        if key in self.live:
+            self.spawn(record)
+        else:
+            self.cold.setdefault(key, []).append(record)
+            level_bounds.union_ip(pygame.Rect(record[1], record[2], self.cell_size, self.cell_size))
+
+    def spawn(self, record):
+        tile_type, x, y, variant, extra = record
+        sprite = place_entity((x, y), tile_type, variant)
+        if sprite is not None:
+            sprite.restore_extra(extra)
+        return sprite
+
+    def mark(self, pos):
+        if not self.quiet:
+            self.dirty.add(self.key_at(pos))
+            self.edits += 1
+
+    def track(self, sprite):
+        # Moving entities dirty both chunks when they cross into another one.
+        # That needs saving, but isn't an edit of the level
+        key = self.key_at(sprite.rect.topleft)
+        if key != sprite.saved_key:
+            if not self.quiet:
+                self.dirty.update((sprite.saved_key, key))
+            sprite.saved_key = key
+
+    def chunk_origin(self, key):
+        return key[0] * self.chunk_size, key[1] * self.chunk_size
+
+    def adopt(self, sprite):
+        key = self.key_at(sprite.rect.topleft)
+        self.live.setdefault(key, {})[sprite] = None
+        sprite.chunk = key
+        sprite.saved_key = key
+        self.live_count += 1
+        self.mark(sprite.rect.topleft)
+
+    def discard(self, sprite):
+        key = getattr(sprite, 'chunk', None)
+        if key is None:
+            return
+        sprites = self.live.get(key)
+        if sprites is not None:
+            sprites.pop(sprite, None)
+        sprite.chunk = None
+        self.live_count -= 1
+        self.mark(sprite.rect.topleft)
+
+    def attach(self, source):
+        self.source = source
+        self.read_strips = set()
+        level_bounds.union_ip(source.bounds())
+
+    def detach(self):
+        # Pull whatever is still unread into memory and let go of the file
+        if self.source is not None:
+            for chunk_x in self.unread_strips():
+                self.read_strip(chunk_x)
+            self.source.close()
+            self.source = None
+
+    def unread_strips(self):
+        if self.source is None:
+            return []
+        bounds = self.source.bounds()
+        size = self.chunk_size
+        return [chunk_x for chunk_x in range(bounds.left // size, (bounds.right - 1) // size + 1)
+                if chunk_x not in self.read_strips]
+
+    def read_strip(self, chunk_x):
+        if self.source is None or chunk_x in self.read_strips:
+            return
+        self.read_strips.add(chunk_x)
+        size = self.chunk_size
+        quiet, self.quiet = self.quiet, True
+        for record in self.source.records_between(chunk_x * size, (chunk_x + 1) * size):
+            self.store(record)
+        self.quiet = quiet
+
+    def load_at(self, pos):
+        key = self.key_at(pos)
+        self.read_strip(key[0])
+        if key in self.cold:
+            self.materialize(key)
+
+    def materialize(self, key):
+        records = self.cold.pop(key)
+        self.live.setdefault(key, {})  # Live before spawning, so place_entity doesn't recurse
+        quiet, self.quiet = self.quiet, True
+        for record in records:
+            self.spawn(record)
+        self.quiet = quiet
+
+    def evict(self, key):
+        quiet, self.quiet = self.quiet, True
+        for sprite in list(self.live.pop(key)):
+            home = self.key_at(sprite.rect.topleft)
+            if home != key and home in self.live:
+                # Wandered into a chunk that is still live: hand it over
+                self.live[home][sprite] = None
+                sprite.chunk = home
+                continue
+            record = sprite.record()
+            sprite.kill()
+            self.cold.setdefault(home, []).append(record)
+        self.quiet = quiet
+
+    def region_records(self, key):
+        # Everything currently positioned in one chunk, live or not
+        self.read_strip(key[0])
+        size = self.chunk_size
+        region = pygame.Rect(self.chunk_origin(key), (size, size))
+        sprites = dict.fromkeys(self.live.get(key, ()))
+        sprites.update(dict.fromkeys(sprite_layer.query(region)))
+        records = [sprite.record() for sprite in sprites
+                   if sprite.alive() and self.key_at(sprite.rect.topleft) == key]
+        records.extend(tile_map.records_in(region))
+        records.extend(self.cold.get(key, ()))
+        return records
+
+    def replace_region(self, region, records):
+        # Used while loading: the region ends up holding exactly these records
+        size = self.chunk_size
+        for chunk_x in range(region.left // size, (region.right - 1) // size + 1):
+            self.read_strip(chunk_x)
+            for chunk_y in range(region.top // size, (region.bottom - 1) // size + 1):
+                kept = [record for record in self.cold.pop((chunk_x, chunk_y), ())
+                        if not region.collidepoint(record[1], record[2])]
+                if kept:
+                    self.cold[(chunk_x, chunk_y)] = kept
+        quiet, self.quiet = self.quiet, True
+        for sprite in sprite_layer.query(region):
+            if sprite.alive() and region.collidepoint(sprite.rect.topleft):
+                sprite.kill()
+        tile_map.clear_region(region)
+        static_layer.invalidate()
+        reachability.invalidate()
+        for record in records:
+            self.store(record)
+        self.quiet = quiet
+
+    def update(self, view_rect):
+        size = self.chunk_size
+        wanted = set()
+        for chunk_x in range(view_rect.left // size, (view_rect.right - 1) // size + 1):
+            self.read_strip(chunk_x)
+        for chunk_y in range(view_rect.top // size, (view_rect.bottom - 1) // size + 1):
+            for chunk_x in range(view_rect.left // size, (view_rect.right - 1) // size + 1):
+                key = (chunk_x, chunk_y)
+                wanted.add(key)
+                if key in self.cold:
+                    self.materialize(key)
+                if key in self.live:
+                    self.live.move_to_end(key)
+        for key in list(self.live):
+            if self.live_count <= self.max_live:
+                break
+            if key not in wanted:
+                self.evict(key)
+
+    def load_all(self):
+        self.detach()
+        for key in list(self.cold):
+            self.materialize(key)
+
+    def cold_records(self):
+        for records in self.cold.values():
+            yield from records
+        # Strips never read are passed straight through from the file
+        size = self.chunk_size
+        for chunk_x in self.unread_strips():
+            yield from self.source.records_between(chunk_x * size, (chunk_x + 1) * size)
+
+    def clear(self):
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+        self.read_strips = set()
+        self.cold.clear()
+        self.live.clear()
+        self.live_count = 0
+        self.dirty.clear()
+        self.dirty_all = True
+        self.edits += 1
+
+    def rebuild(self, sprites, cell_size=None):
+        if cell_size is not None:
+            self.cell_size = cell_size
+        self.clear()
+        self.quiet = True
+        for sprite in sprites:
+            self.adopt(sprite)
+        self.quiet = False
+
+# Dirty-rect display updates: the frame is still composed in full, but in the
+# editor only regions that changed are pushed to the display, which is what
+# costs the most on software-rendered remote desktops
+DIRTY_RECT_UPDATES = True
+MAX_DIRTY_RECTS = 200  # Beyond this many regions a full update is cheaper
+
+class DirtyRegions:
+    def __init__(self, max_rects=MAX_DIRTY_RECTS):
+        self.max_rects = max_rects
+        self.rects = []
+        self.everything = True
+        self.camera = None
+        self.paused = False  # Set while loading, when everything is redrawn after
+
+    def mark(self, rect):
+        if self.paused:
+            return
+        # World-space rect, mapped onto the play area through the camera
+        if self.camera is not None:
+            rect = self.camera.to_screen(pygame.Rect(rect)).clip(self.camera.view)
+            if not rect:
+                return
+        self.mark_screen(rect)
+
+    def mark_screen(self, rect):
+        if not self.everything:
+            self.rects.append(pygame.Rect(rect))
+            if len(self.rects) > self.max_rects:
+                self.mark_all()
+
+    def mark_all(self):
+        self.everything = True
+        self.rects = []
+
+    def track(self, sprites):
+        # Mark where moving sprites were last drawn and where they are now
+        for sprite in sprites:
+            drawn_rect = getattr(sprite, 'drawn_rect', None)
+            if drawn_rect != sprite.rect:
+                if drawn_rect is not None:
+                    self.mark(drawn_rect)
+                self.mark(sprite.rect)
+                sprite.drawn_rect = sprite.rect.copy()
+
+    def present(self):
+        if self.everything or not DIRTY_RECT_UPDATES:
+            pygame.display.update()
+        elif self.rects:
+            pygame.display.update(self.rects)
+        self.everything = False
+        self.rects = []
 
-    def update_image(self):
-        theme_colors = themes[current_theme]
-        self.image.fill(theme_colors.get(self.tile_type, WHITE))
-        
-        # Additional graphics for specific tiles
-        if self.tile_type == 'question':
-            pygame.draw.line(self.image, BLACK, (10, 10), (30, 10), 3)
-            pygame.draw.line(self.image, BLACK, (10, 10), (10, 30), 3)
-            pygame.draw.line(self.image, BLACK, (30, 10), (30, 30), 3)
-        elif self.tile_type == 'coin':
-            pygame.draw.circle(self.image, WHITE, (GRID_SIZE // 2, GRID_SIZE // 2), GRID_SIZE // 2 - 5)
-        elif self.tile_type == 'pipe':
-            pygame.draw.rect(self.image, BLACK, (2, 2, GRID_SIZE - 4, GRID_SIZE - 4), 2)
-        elif self.tile_type == 'platform':
-            self.image.fill((0, 0, 0, 0))  # Transparent
-            pygame.draw.rect(self.image, theme_colors.get('ground'), (0, 0, GRID_SIZE, GRID_SIZE // 4))
-        elif self.tile_type == 'powerup':
-            pygame.draw.rect(self.image, theme_colors.get('powerup'), (5, 5, GRID_SIZE - 10, GRID_SIZE - 10))
-            pygame.draw.rect(self.image, WHITE, (10, 10, GRID_SIZE - 20, GRID_SIZE - 20))
-
-class Enemy(pygame.sprite.Sprite):
-    def __init__(self, pos, enemy_type='goomba'):
+dirty = DirtyRegions()
+
+# Texture painters: each draws one look from scratch at the given size
+def paint_tile(theme_colors, tile_type, size):
+    image = pygame.Surface((size, size))
+    image.fill(theme_colors.get(tile_type, WHITE))
+    
+    # Additional graphics for specific tiles
+    if tile_type == 'question':
+        pygame.draw.line(image, BLACK, (10, 10), (30, 10), 3)
+        pygame.draw.line(image, BLACK, (10, 10), (10, 30), 3)
+        pygame.draw.line(image, BLACK, (30, 10), (30, 30), 3)
+    elif tile_type == 'coin':
+        pygame.draw.circle(image, WHITE, (size // 2, size // 2), size // 2 - 5)
+    elif tile_type == 'pipe':
+        pygame.draw.rect(image, BLACK, (2, 2, size - 4, size - 4), 2)
+    elif tile_type == 'platform':
+        image.fill((0, 0, 0, 0))  # Transparent
+        pygame.draw.rect(image, theme_colors.get('ground'), (0, 0, size, size // 4))
+    elif tile_type == 'powerup':
+        pygame.draw.rect(image, theme_colors.get('powerup'), (5, 5, size - 10, size - 10))
+        pygame.draw.rect(image, WHITE, (10, 10, size - 20, size - 20))
+    return image
+
+def paint_enemy(theme_colors, enemy_type, size):
+    image = pygame.Surface((size, size))
+    image.fill(theme_colors['enemy'])
+    
+    # Draw enemy details based on type
+    if enemy_type == 'goomba':
+        pygame.draw.ellipse(image, BLACK, (5, 25, 40, 20))
+        pygame.draw.circle(image, WHITE, (15, 15), 5)
+        pygame.draw.circle(image, WHITE, (35, 15), 5)
+    elif enemy_type == 'koopa':
+        pygame.draw.rect(image, (0, 200, 0), (5, 5, 40, 40))
+        pygame.draw.ellipse(image, WHITE, (10, 10, 30, 20))
+    elif enemy_type == 'piranha':
+        pygame.draw.polygon(image, (0, 200, 0), [(10, 10), (40, 10), (40, 40), (10, 40)])
+        pygame.draw.circle(image, WHITE, (25, 25), 5)
+    return image
+
+def paint_coin(theme_colors, face, size):
+    image = pygame.Surface((size, size), pygame.SRCALPHA)
+    if face == 'edge':
+        # Thin coin seen edge-on while spinning
+        pygame.draw.ellipse(image, theme_colors['coin'], (size // 2 - 3, 10, 6, size - 20))
+    else:
+        pygame.draw.circle(image, theme_colors['coin'], (size // 2, size // 2), size // 2 - 5)
+        pygame.draw.circle(image, (255, 255, 200), (size // 2, size // 2), size // 2 - 10)
+    return image
+
+def paint_powerup(theme_colors, powerup_type, size):
+    image = pygame.Surface((size, size), pygame.SRCALPHA)
+    if powerup_type == 'mushroom':
+        pygame.draw.rect(image, RED, (5, 20, size - 10, size - 25))
+        pygame.draw.circle(image, RED, (size // 2, 20), size // 2 - 5)
+        pygame.draw.circle(image, WHITE, (size // 3, 15), 5)
+        pygame.draw.circle(image, WHITE, (2 * size // 3, 15), 5)
+    elif powerup_type == 'fire_flower':
+        pygame.draw.circle(image, RED, (size // 2, size // 2), size // 2 - 5)
+        pygame.draw.circle(image, YELLOW, (size // 2, size // 2), size // 3)
+    elif powerup_type == 'star':
+        points = []
+        for i in range(5):
+            angle = i * 2 * 3.14159 / 5 - 3.14159 / 2
+            outer_x = size // 2 + int((size // 2 - 5) * math.cos(angle))
+            outer_y = size // 2 + int((size // 2 - 5) * math.sin(angle))
+            points.append((outer_x, outer_y))
+            
+            inner_angle = angle + 3.14159 / 5
+            inner_x = size // 2 + int((size // 4) * math.cos(inner_angle))
+            inner_y = size // 2 + int((size // 4) * math.sin(inner_angle))
+            points.append((inner_x, inner_y))
+        pygame.draw.polygon(image, YELLOW, points)
+    return image
+
+def paint_icon(theme_colors, tile_type, size):
+    icon = pygame.Surface((size, size), pygame.SRCALPHA)
+    if tile_type in theme_colors:
+        icon.fill(theme_colors[tile_type])
+    elif tile_type == 'platform':
+        icon.fill((100, 100, 100, 150))
+        pygame.draw.rect(icon, theme_colors.get('ground'), (0, 0, size, size // 4))
+    else:
+        icon.fill(WHITE)
+    return icon
+
+# Texture atlas: every look is painted once per (theme, kind, variant, grid size)
+# and shared by all sprites that use it, so sprites must never draw on their image
+class TextureAtlas:
+    def __init__(self, painters):
+        self.painters = painters
+        self.surfaces = {}
+
+    def get(self, kind, variant=None, size=None, theme=None):
+        key = (theme or current_theme, kind, variant, size or GRID_SIZE)
+        surface = self.surfaces.get(key)
+        if surface is None:
+            surface = self.painters[kind](themes[key[0]], variant, key[3])
+            if pygame.display.get_surface() is not None:
+                if surface.get_flags() & pygame.SRCALPHA:
+                    surface = surface.convert_alpha()
+                else:
+                    surface = surface.convert()
+            self.surfaces[key] = surface
+        return surface
+
+    def clear(self):
+        self.surfaces.clear()
+
+# Coin spin cycle, one atlas face per animation frame
+COIN_SPIN_FRAMES = ['face', 'edge', 'face', 'edge']
+COIN_FRAME_TICKS = 10  # Frames the coin holds each face
+
+# Shared animation clock: decorative sprites animate in lockstep, so one clock
+# advanced per frame replaces their per-sprite update() calls. Sprites read
+# the current frame index when they are drawn.
+class AnimationClock:
+    def __init__(self, tracks):
+        self.tracks = tracks
+        self.ticks = 0
+        self.frames = {}
+
+    def tick(self):
+        self.ticks += 1
+        self.frames.clear()
+
+    def frame(self, kind):
+        index = self.frames.get(kind)
+        if index is None:
+            index = self.frames[kind] = self.tracks[kind](self.ticks)
+        return index
+
+# Seeded random streams: each level carries a seed, and every playtest reseeds
+# all streams from it. Separate streams per purpose keep, say, enemy behaviour
+# from shifting when some other random use is added or removed. String seeds
+# are hashed with SHA-512 by random.Random, so they are stable across runs
+class RngStreams:
+    def __init__(self, seed=0):
+        self.reset(seed)
+
+    def reset(self, seed):
+        self.seed = seed
+        self.streams = {}
+
+    def stream(self, name):
+        stream = self.streams.get(name)
+        if stream is None:
+            stream = self.streams[name] = random.Random(f"{self.seed}:{name}")
+        return stream
+
+rng = RngStreams()
+level_seed = 0
+
+anim_clock = AnimationClock({
+    'coin': lambda ticks: (ticks // COIN_FRAME_TICKS) % len(COIN_SPIN_FRAMES),
+})
+
+atlas = TextureAtlas({
+    'tile': paint_tile,
+    'enemy': paint_enemy,
+    'coin': paint_coin,
+    'powerup': paint_powerup,
+    'icon': paint_icon,
+})
+
+# Classes for various game elements. Tiles live in the tile map; everything
+# else placed in a level is an entity. Entities hold what only they use; the
+# data systems work on, and where they are filed, is up to World, by the
+# components of their kind. sprite: drawn one by one; walker: moved by
+# step_walkers(); hazard: hurts on contact; stompable: dies when landed on;
+# pickup: collected on contact; animated: image changes with the animation clock
+ARCHETYPES = {
+    'enemy': ('sprite', 'walker', 'hazard', 'stompable'),
+    'coin': ('sprite', 'pickup', 'animated'),
+    'powerup': ('sprite', 'walker', 'pickup'),
+}
+
+class Entity(pygame.sprite.Sprite):
+    kind = None
+    slot = None  # Row in the world's arrays while spawned
+    cell = None
+
+    def kill(self):
+        world.despawn(self)
+
+    def alive(self):
+        return self.slot is not None
+
+    def restore_extra(self, extra):
+        pass
+
+# Walker physics for enemies and power-ups, batched. Positions, velocities and
+# facing of every walker live in the world's arrays, and step_walkers() moves
+# all the active ones at once against the tile map's solid cells. Each tick:
+# gravity, move on x and reverse at walls, move on y and land or bump, then
+# hazards (enemies) bounce off the level edges
+ENEMY_ANIMATION_SPEED = 0.1
+KOOPA_JUMP_CHANCE = 0.01
+KOOPA_JUMP_SPEED = -8
+
+def round_position(values):
+    # pygame.Rect rounds float coordinates half away from zero
+    return (np.sign(values) * np.floor(np.abs(values) + 0.5)).astype(np.int64)
+
+def walker_hits(solid_map, x, y, w, h):
+    # For each walker: how many solid cells its rect overlaps, and the first
+    # and last of them row by row
+    if not len(solid_map.occupied):
+        nothing = np.zeros(len(x), np.int64)
+        return nothing, nothing, nothing, nothing, nothing
+    size = solid_map.cell_size
+    span_cols = int(w.max()) // size + 2
+    span_rows = int(h.max()) // size + 2
+    left, top = np.maximum(x // size, 0), np.maximum(y // size, 0)
+    right = np.minimum((x + w - 1) // size, solid_map.cols - 1)
+    bottom = np.minimum((y + h - 1) // size, solid_map.rows - 1)
+    cols = left[:, None] + np.arange(span_cols)
+    rows = top[:, None] + np.arange(span_rows)
+    inside = (rows <= bottom[:, None])[:, :, None] & (cols <= right[:, None])[:, None, :]
+    cells = np.where(inside, rows[:, :, None] * solid_map.cols + cols[:, None, :], 0)
+    hit = (inside & solid_map.occupied[cells]).reshape(len(x), -1)
+    count = hit.sum(axis=1)
+    first = hit.argmax(axis=1)
+    last = hit.shape[1] - 1 - hit[:, ::-1].argmax(axis=1)
+    span = np.arange(len(x))
+    return (count,
+            cols[span, first % span_cols], rows[span, first // span_cols],
+            cols[span, last % span_cols], rows[span, last // span_cols])
+
+def step_walkers(slots, solid_map):
+    # Advance the walkers in the given world slots one tick. Returns the ones
+    # that moved into another grid cell, spatial bucket or level chunk, for the
+    # caller's bookkeeping
+    if not len(slots):
+        return []
+    size = solid_map.cell_size
+    x, y, w, h = world.x[slots], world.y[slots], world.w[slots], world.h[slots]
+    vx, vy = world.vx[slots], world.vy[slots]
+    facing = world.facing_right[slots]
+    enemy = world.hazard[slots]
+    old_x, old_y = x, y
+
+    vy = np.minimum(vy + GRAVITY, TERMINAL_VELOCITY)
+
+    # Move horizontally. Each wall overlapped reverses the walker and puts it
+    # against that wall, so an odd number of hits turns it round and the last
+    # wall decides where it ends up
+    x = round_position(x + vx)
+    count, _, _, last_col, _ = walker_hits(solid_map, x, y, w, h)
+    moving = (count > 0) & (vx != 0)
+    last_right = np.sign(vx) * np.where(count % 2 == 1, 1, -1) > 0  # Heading right into the last wall
+    x = np.where(moving & last_right, last_col * size - w, np.where(moving, (last_col + 1) * size, x))
+    facing = np.where(moving & enemy, ~last_right, facing)
+    vx = np.where(moving & (count % 2 == 1), -vx, vx)
+
+    # Move vertically: the first tile hit lands or bumps it
+    y = round_position(y + vy)
+    count, _, first_row, _, _ = walker_hits(solid_map, x, y, w, h)
+    landing = (count > 0) & (vy > 0)
+    bumping = (count > 0) & (vy < 0)
+    y = np.where(landing, first_row * size - h, np.where(bumping, (first_row + 1) * size, y))
+    vy = np.where(landing | bumping, 0.0, vy)
+
+    return finish_walkers(slots, x, y, vx, vy, facing, old_x, old_y)
+
+def finish_walkers(slots, x, y, vx, vy, facing, old_x, old_y):
+    w, h = world.w[slots], world.h[slots]
+    enemy = world.hazard[slots]
+    rows = world.rows
+
+    # Special enemy behaviors: koopas set to jump hop now and then, drawing
+    # from the enemies stream in update order
+    for index in np.flatnonzero(world.is_koopa[slots] & (vy == 0)).tolist():
+        sprite = rows[slots[index]]
+        if sprite.movement_pattern == 'jump' and rng.stream('enemies').random() < KOOPA_JUMP_CHANCE:
+            vy[index] = KOOPA_JUMP_SPEED
+
+    # Animation
+    timer = world.anim_timer[slots] + ENEMY_ANIMATION_SPEED
+    wrapped = enemy & (timer >= 1)
+    world.anim_timer[slots] = np.where(enemy, np.where(wrapped, 0.0, timer), world.anim_timer[slots])
+    world.anim_frame[slots] = np.where(wrapped, (world.anim_frame[slots] + 1) % 2, world.anim_frame[slots])
+
+    # Flip direction if at edge of the level
+    at_left = enemy & (x <= 0)
+    at_right = enemy & ~at_left & (x + w >= level_bounds.right)
+    vx = np.where(at_left, np.abs(vx), np.where(at_right, -np.abs(vx), vx))
+    facing = np.where(at_left, True, np.where(at_right, False, facing))
+
+    world.x[slots], world.y[slots], world.vx[slots], world.vy[slots] = x, y, vx, vy
+    world.facing_right[slots] = facing
+
+    moved = np.flatnonzero((x != old_x) | (y != old_y))
+    for index, new_x, new_y in zip(moved.tolist(), x[moved].tolist(), y[moved].tolist()):
+        rows[slots[index]].rect.topleft = (new_x, new_y)
+
+    # Only walkers crossing a cell, bucket or chunk boundary need re-filing
+    bucket, chunk, cell = sprite_layer.bucket_size, level_chunks.chunk_size, cell_index.cell_size
+    crossed = (((old_x + w // 2) // bucket != (x + w // 2) // bucket)
+               | ((old_y + h // 2) // bucket != (y + h // 2) // bucket)
+               | ((old_x + w // 2) // cell != (x + w // 2) // cell)
+               | ((old_y + h // 2) // cell != (y + h // 2) // cell)
+               | (old_x // chunk != x // chunk) | (old_y // chunk != y // chunk))
+    return [rows[slot] for slot in slots[crossed].tolist()]
+
+# Motion state is kept by the world; velocity reads back a copy
+walker_velocity = property(lambda sprite: world.velocity(sprite),
+                           lambda sprite, velocity: world.set_velocity(sprite, velocity))
+
+class Enemy(Entity):
+    def __init__(self, pos, enemy_type=None):
         super().__init__()
-        self.enemy_type = enemy_type
-        self.image = pygame.Surface((GRID_SIZE, GRID_SIZE))
-        self.image.fill(themes[current_theme]['enemy'])
+        self.enemy_type = enemy_type or 'goomba'
+        self.image = atlas.get('enemy', self.enemy_type)
         self.rect = self.image.get_rect(topleft=pos)
-        self.velocity = pygame.Vector2(2, 0)  # Initial movement
-        
+
         # Mario Fan Builder-style enemy properties
         self.movement_pattern = 'walk'  # 'walk', 'jump', 'fly', etc.
-        self.can_be_stomped = True
         self.health = 1
-        self.is_facing_right = False
-        self.animation_frame = 0
-        self.animation_speed = 0.1
-        self.animation_timer = 0
-        
-        # Draw enemy details based on type
-        if enemy_type == 'goomba':
-            pygame.draw.ellipse(self.image, BLACK, (5, 25, 40, 20))
-            pygame.draw.circle(self.image, WHITE, (15, 15), 5)
-            pygame.draw.circle(self.image, WHITE, (35, 15), 5)
-        elif enemy_type == 'koopa':
-            pygame.draw.rect(self.image, (0, 200, 0), (5, 5, 40, 40))
-            pygame.draw.ellipse(self.image, WHITE, (10, 10, 30, 20))
-        elif enemy_type == 'piranha':
-            pygame.draw.polygon(self.image, (0, 200, 0), [(10, 10), (40, 10), (40, 40), (10, 40)])
-            pygame.draw.circle(self.image, WHITE, (25, 25), 5)
-
-    def update(self, solid_tiles, platforms=None):
-        # Apply gravity if not on ground
-        self.velocity.y += GRAVITY
-        self.velocity.y = min(self.velocity.y, TERMINAL_VELOCITY)
-        
-        # Move horizontally
-        self.rect.x += self.velocity.x
-        
-        # Check horizontal collisions
-        collisions = pygame.sprite.spritecollide(self, solid_tiles, False)
-        for tile in collisions:
-            if self.velocity.x > 0:  # Moving right
-                self.rect.right = tile.rect.left
-                self.velocity.x *= -1
-                self.is_facing_right = False
-            elif self.velocity.x < 0:  # Moving left
-                self.rect.left = tile.rect.right
-                self.velocity.x *= -1
-                self.is_facing_right = True
-        
-        # Move vertically
-        self.rect.y += self.velocity.y
-        
-        # Check vertical collisions
-        collisions = pygame.sprite.spritecollide(self, solid_tiles, False)
-        for tile in collisions:
-            if self.velocity.y > 0:  # Falling
-                self.rect.bottom = tile.rect.top
-                self.velocity.y = 0
-            elif self.velocity.y < 0:  # Jumping
-                self.rect.top = tile.rect.bottom
-                self.velocity.y = 0
-                
-        # Special enemy behaviors
-        if self.enemy_type == 'koopa' and self.movement_pattern == 'jump':
-            # Periodically jump
-            if self.velocity.y == 0 and random.random() < 0.01:
-                self.velocity.y = -8
-                
-        # Update animation
-        self.animation_timer += self.animation_speed
-        if self.animation_timer >= 1:
-            self.animation_timer = 0
-            self.animation_frame = (self.animation_frame + 1) % 2
-            
-        # Flip direction if at edge of screen
-        if self.rect.left <= 0:
-            self.velocity.x = abs(self.velocity.x)
-            self.is_facing_right = True
-        elif self.rect.right >= WINDOW_WIDTH:
-            self.velocity.x = -abs(self.velocity.x)
-            self.is_facing_right = False
-
-class Coin(pygame.sprite.Sprite):
-    def __init__(self, pos):
+
+    velocity = walker_velocity
+
+    @property
+    def is_facing_right(self):
+        return self.slot is not None and bool(world.facing_right[self.slot])
+
+    @property
+    def animation_frame(self):
+        return 0 if self.slot is None else int(world.anim_frame[self.slot])
+
+    def update_image(self):
+        self.image = atlas.get('enemy', self.enemy_type, self.rect.width)
+
+    def record(self):
+        return ('enemy', self.rect.x, self.rect.y, self.enemy_type, None)
+
+class Coin(Entity):
+    def __init__(self, pos, variant=None):
         super().__init__()
-        self.image = pygame.Surface((GRID_SIZE, GRID_SIZE), pygame.SRCALPHA)
-        self.draw_coin()
-        self.rect = self.image.get_rect(topleft=pos)
-        self.animation_frame = 0
-        self.animation_speed = 0.1
-        self.animation_timer = 0
-        self.value = 1  # Mario Fan Builder has different coin values
-        
-    def draw_coin(self):
-        self.image.fill((0, 0, 0, 0))  # Clear with transparency
-        pygame.draw.circle(self.image, themes[current_theme]['coin'], 
-                          (GRID_SIZE // 2, GRID_SIZE // 2), GRID_SIZE // 2 - 5)
-        pygame.draw.circle(self.image, (255, 255, 200), 
-                          (GRID_SIZE // 2, GRID_SIZE // 2), GRID_SIZE // 2 - 10)
-        
-    def update(self):
-        # Animate the coin (spinning effect)
-        self.animation_timer += self.animation_speed
-        if self.animation_timer >= 1:
-            self.animation_timer = 0
-            self.animation_frame = (self.animation_frame + 1) % 4
-            
-            # Update appearance based on frame
-            self.draw_coin()
-            if self.animation_frame in [1, 3]:
-                # Make the coin appear thinner when spinning
-                self.image.fill((0, 0, 0, 0))
-                pygame.draw.ellipse(self.image, themes[current_theme]['coin'], 
-                                   (GRID_SIZE // 2 - 3, 10, 6, GRID_SIZE - 20))
-
-class PowerUp(pygame.sprite.Sprite):
-    def __init__(self, pos, powerup_type='mushroom'):
+        self.rect = pygame.Rect(pos, (GRID_SIZE, GRID_SIZE))
+        self.update_image()
+
+    def update_image(self):
+        self.frames = [atlas.get('coin', face, self.rect.width) for face in COIN_SPIN_FRAMES]
+
+    def record(self):
+        return ('coin', self.rect.x, self.rect.y, None, self.value)
+
+    def restore_extra(self, value):
+        self.value = value
+
+    @property
+    def value(self):
+        # Mario Fan Builder has different coin values
+        return int(world.value[self.slot])
+
+    @value.setter
+    def value(self, value):
+        world.value[self.slot] = value
+
+    @property
+    def image(self):
+        # Spinning effect, driven by the shared clock (thinner when spinning)
+        return self.frames[anim_clock.frame('coin')]
+
+class PowerUp(Entity):
+    def __init__(self, pos, powerup_type=None):
         super().__init__()
-        self.powerup_type = powerup_type
-        self.image = pygame.Surface((GRID_SIZE, GRID_SIZE), pygame.SRCALPHA)
+        self.powerup_type = powerup_type or 'mushroom'
+        self.image = atlas.get('powerup', self.powerup_type)
         self.rect = self.image.get_rect(topleft=pos)
-        self.velocity = pygame.Vector2(2, 0)
-        
-        # Draw the power-up
-        if powerup_type == 'mushroom':
-            pygame.draw.rect(self.image, RED, (5, 20, GRID_SIZE - 10, GRID_SIZE - 25))
-            pygame.draw.circle(self.image, RED, (GRID_SIZE // 2, 20), GRID_SIZE // 2 - 5)
-            pygame.draw.circle(self.image, WHITE, (GRID_SIZE // 3, 15), 5)
-            pygame.draw.circle(self.image, WHITE, (2 * GRID_SIZE // 3, 15), 5)
-        elif powerup_type == 'fire_flower':
-            pygame.draw.circle(self.image, RED, (GRID_SIZE // 2, GRID_SIZE // 2), GRID_SIZE // 2 - 5)
-            pygame.draw.circle(self.image, YELLOW, (GRID_SIZE // 2, GRID_SIZE // 2), GRID_SIZE // 3)
-        elif powerup_type == 'star':
-            points = []
-            for i in range(5):
-                angle = i * 2 * 3.14159 / 5 - 3.14159 / 2
-                outer_x = GRID_SIZE // 2 + int((GRID_SIZE // 2 - 5) * math.cos(angle))
-                outer_y = GRID_SIZE // 2 + int((GRID_SIZE // 2 - 5) * math.sin(angle))
-                points.append((outer_x, outer_y))
-                
-                inner_angle = angle + 3.14159 / 5
-                inner_x = GRID_SIZE // 2 + int((GRID_SIZE // 4) * math.cos(inner_angle))
-                inner_y = GRID_SIZE // 2 + int((GRID_SIZE // 4) * math.sin(inner_angle))
-                points.append((inner_x, inner_y))
-            pygame.draw.polygon(self.image, YELLOW, points)
-    
-    def update(self, solid_tiles):
-        # Apply gravity
-        self.velocity.y += GRAVITY
-        self.velocity.y = min(self.velocity.y, TERMINAL_VELOCITY)
-        
-        # Move horizontally
-        self.rect.x += self.velocity.x
-        
-        # Check horizontal collisions
-        collisions = pygame.sprite.spritecollide(self, solid_tiles, False)
-        for tile in collisions:
-            if self.velocity.x > 0:  # Moving right
-                self.rect.right = tile.rect.left
-                self.velocity.x *= -1
-            elif self.velocity.x < 0:  # Moving left
-                self.rect.left = tile.rect.right
-                self.velocity.x *= -1
-        
-        # Move vertically
-        self.rect.y += self.velocity.y
-        
-        # Check vertical collisions
-        collisions = pygame.sprite.spritecollide(self, solid_tiles, False)
-        for tile in collisions:
-            if self.velocity.y > 0:  # Falling
-                self.rect.bottom = tile.rect.top
-                self.velocity.y = 0
-            elif self.velocity.y < 0:  # Rising
-                self.rect.top = tile.rect.bottom
-                self.velocity.y = 0
+
+    velocity = walker_velocity
+
+    def update_image(self):
+        self.image = atlas.get('powerup', self.powerup_type, self.rect.width)
+
+    def record(self):
+        return ('powerup', self.rect.x, self.rect.y, self.powerup_type, None)
+
+ENTITY_CLASSES = {'enemy': Enemy, 'coin': Coin, 'powerup': PowerUp}
+
+# The level's entities, stored by component. Each spawned entity has a slot, its
+# row in the arrays below (swap-removed on despawn). Every component is a bool
+# column saying which entities have it, and the data the systems and walker
+# kernel work on sits in dense columns beside them, so a system picks out its
+# entities with a mask and handles them all at once. indexes are the spatial
+# structures an entity joins for each of its components. spawn() and despawn()
+# are the only places any of it changes
+class World:
+    COMPONENTS = ('sprite', 'walker', 'hazard', 'stompable', 'pickup', 'animated')
+    COLUMNS = {
+        'x': np.int64, 'y': np.int64, 'w': np.int64, 'h': np.int64,  # Rect, kept in step with entity.rect
+        'vx': float, 'vy': float, 'facing_right': bool,                # walker
+        'anim_timer': float, 'anim_frame': np.int64,                   # Walking animation of hazards
+        'is_koopa': bool,
+        'value': np.int64,                                             # pickup: what a coin is worth
+    }
+
+    def __init__(self, indexes, capacity=64):
+        self.indexes = indexes  # component -> index with add(entity)/remove(entity)
+        self.entities = {}      # entity -> None, in spawn order
+        self.rows = []          # Entity in each slot
+        self.despawns = 0       # Despawning moves a slot: held slot arrays go stale
+        self.columns = dict(self.COLUMNS, **dict.fromkeys(self.COMPONENTS, bool))
+        for name, dtype in self.columns.items():
+            setattr(self, name, np.zeros(capacity, dtype))
+
+    def of(self, component):
+        column = getattr(self, component)
+        return [entity for entity in self.entities if column[entity.slot]]
+
+    def slots(self, entities):
+        # Slots of the entities still spawned, in the order given
+        return np.fromiter((entity.slot for entity in entities if entity.slot is not None), np.intp)
+
+    def at(self, slots):
+        return [self.rows[slot] for slot in slots.tolist()]
+
+    def overlapping(self, rect, slots):
+        # Which of the slots' rects overlap rect
+        x, y = self.x[slots], self.y[slots]
+        return ((x < rect.right) & (x + self.w[slots] > rect.left)
+                & (y < rect.bottom) & (y + self.h[slots] > rect.top))
+
+    def velocity(self, entity):
+        if entity.slot is None:
+            return pygame.Vector2(0, 0)
+        return pygame.Vector2(self.vx[entity.slot], self.vy[entity.slot])
+
+    def set_velocity(self, entity, velocity):
+        self.vx[entity.slot], self.vy[entity.slot] = velocity
+
+    def spawn(self, kind, pos, variant=None):
+        entity = ENTITY_CLASSES[kind](pos, variant)
+        entity.kind = kind
+        slot = len(self.rows)
+        if slot == len(self.x):
+            for name in self.columns:
+                array = getattr(self, name)
+                setattr(self, name, np.concatenate([array, np.zeros_like(array)]))
+        self.rows.append(entity)
+        entity.slot = slot
+        self.x[slot], self.y[slot], self.w[slot], self.h[slot] = entity.rect
+        self.vx[slot], self.vy[slot] = 2, 0
+        self.facing_right[slot] = False
+        self.anim_timer[slot] = 0
+        self.anim_frame[slot] = 0
+        self.is_koopa[slot] = getattr(entity, 'enemy_type', None) == 'koopa'
+        self.value[slot] = 1
+        for component in self.COMPONENTS:
+            getattr(self, component)[slot] = component in ARCHETYPES[kind]
+        self.entities[entity] = None
+        for component in ARCHETYPES[kind]:
+            index = self.indexes.get(component)
+            if index is not None:
+                index.add(entity)
+        level_chunks.adopt(entity)
+        dirty.mark(entity.rect)
+        return entity
+
+    def despawn(self, entity):
+        slot = entity.slot
+        if slot is None:
+            return
+        last = len(self.rows) - 1
+        if slot != last:
+            moved = self.rows[last]
+            self.rows[slot] = moved
+            moved.slot = slot
+            for name in self.columns:
+                array = getattr(self, name)
+                array[slot] = array[last]
+        self.rows.pop()
+        entity.slot = None
+        self.despawns += 1
+        del self.entities[entity]
+        for component in ARCHETYPES[entity.kind]:
+            index = self.indexes.get(component)
+            if index is not None:
+                index.remove(entity)
+        cell_index.remove(entity)
+        level_chunks.discard(entity)
+        dirty.mark(entity.rect)
+
+    def rebuild(self):
+        # Rects are re-read (they are snapped when the grid changes)
+        for slot, entity in enumerate(self.rows):
+            self.x[slot], self.y[slot], self.w[slot], self.h[slot] = entity.rect
+
+    def clear(self):
+        for entity in self.rows:
+            entity.slot = None
+        self.rows = []
+        self.entities.clear()
 
 class Player(pygame.sprite.Sprite):
     def __init__(self, pos):
@@ -323,9 +1306,29 @@ class Player(pygame.sprite.Sprite):
         self.run_timer = 0       # For P-meter
         self.p_meter = 0         # 0-6, at 6 allows flight/special abilities
         self.character = 'mario' # 'mario', 'luigi', 'peach', 'toad', etc.
+        self.controls = pygame.key.get_pressed  # Swapped for an InputState when headless
+
+    def reset(self, pos):
+        # A fresh run from pos: nothing from the last level or life carries
+        # over except lives and the character
+        self.rect.center = pos
+        self.velocity = pygame.Vector2(0, 0)
+        self.on_ground = False
+        self.coins_collected = 0
+        self.score = 0
+        self.state = 'small'
+        self.is_running = False
+        self.direction = 'right'
+        self.invincible = False
+        self.invincible_timer = 0
+        self.can_jump = True
+        self.jump_held = False
+        self.jump_timer = 0
+        self.run_timer = 0
+        self.p_meter = 0
 
-    def update(self, solid_tiles, enemies, coins, powerups=None, platforms=None):
-        keys = pygame.key.get_pressed()
+    def update(self, solid_map, platforms=None):
+        keys = self.controls()
         
         # Reset horizontal acceleration
         self.accel_x = 0
@@ -416,360 +1419,1151 @@ class Player(pygame.sprite.Sprite):
             self.can_jump = True
             
         # Apply gravity (varies by character in Mario Fan Builder)
-        gravity_factor = 1.0
-        if self.character == 'luigi':
-            gravity_factor = 0.9  # Luigi jumps higher
-        elif self.character == 'peach':
-            gravity_factor = 0.7  # Peach floats
-            if not self.on_ground and keys[pygame.K_SPACE]:
-                gravity_factor = 0.3  # Even more float when holding jump
-                
+        gravity_factor = CHARACTER_GRAVITY.get(self.character, 1.0)  # Luigi jumps higher, Peach floats
+        if not self.on_ground and keys[pygame.K_SPACE]:
+            gravity_factor = FLOAT_GRAVITY.get(self.character, gravity_factor)  # Even more float when holding jump
+
         self.velocity.y += GRAVITY * gravity_factor
         self.velocity.y = min(self.velocity.y, TERMINAL_VELOCITY)
 
         # Move horizontally and handle collisions
         self.rect.x += self.velocity.x
-        self.handle_collisions(self.velocity.x, 0, solid_tiles)
+        self.handle_collisions(self.velocity.x, 0, solid_map)
 
         # Move vertically and handle collisions
         self.rect.y += self.velocity.y
         self.on_ground = False
-        self.handle_collisions(0, self.velocity.y, solid_tiles)
+        self.handle_collisions(0, self.velocity.y, solid_map)
 
         # Check platform collisions (for one-way platforms)
         if platforms:
             self.handle_platform_collisions(platforms)
 
-        # Prevent player from falling below the screen
-        if self.rect.bottom > WINDOW_HEIGHT:
-            self.rect.bottom = WINDOW_HEIGHT
+        # Prevent player from falling below the level
+        if self.rect.bottom > level_bounds.bottom:
+            self.rect.bottom = level_bounds.bottom
             self.velocity.y = 0
             self.on_ground = True
 
-        # Check collision with enemies
-        enemy_collisions = pygame.sprite.spritecollide(self, enemies, False)
-        for enemy in enemy_collisions:
-            if self.velocity.y > 0 and self.rect.bottom < enemy.rect.centery:
-                if enemy.can_be_stomped:
-                    self.velocity.y = -6  # Bounce up
-                    self.score += 100
-                    enemy.kill()
+    def hurt(self):
+        if self.state != 'small':
+            self.state = 'small'
+            self.invincible = True
+            self.invincible_timer = 60  # Invincibility frames
+        else:
+            self.lives -= 1
+            if self.lives <= 0:
+                print("Game Over!")
             else:
-                if not self.invincible:
-                    if self.state != 'small':
-                        self.state = 'small'
-                        self.invincible = True
-                        self.invincible_timer = 60  # Invincibility frames
-                    else:
-                        self.lives -= 1
-                        if self.lives <= 0:
-                            print("Game Over!")
-                        else:
-                            print(f"Lives left: {self.lives}")
-                        playtest_reset()
-
-        # Check collision with coins
-        collected = pygame.sprite.spritecollide(self, coins, True)
-        for coin in collected:
-            self.coins_collected += coin.value
-            self.score += 200
-
-        # Check collision with powerups
-        if powerups:
-            pu_collected = pygame.sprite.spritecollide(self, powerups, True)
-            for powerup in pu_collected:
-                if powerup.powerup_type == 'mushroom' and self.state == 'small':
-                    self.state = 'big'
-                    self.score += 1000
-                elif powerup.powerup_type == 'fire_flower' and self.state in ['small', 'big']:
-                    self.state = 'fire'
-                    self.score += 1000
-                elif powerup.powerup_type == 'star':
-                    self.invincible = True
-                    self.invincible_timer = 600  # 10 seconds
-                    self.score += 1000
-
-        # Update invincibility timer
+                print(f"Lives left: {self.lives}")
+            playtest_reset()
+
+    def tick_invincibility(self):
         if self.invincible:
             self.invincible_timer -= 1
             if self.invincible_timer <= 0:
                 self.invincible = False
 
-    def handle_collisions(self, vel_x, vel_y, solid_tiles):
-        collisions = pygame.sprite.spritecollide(self, solid_tiles, False)
+    def handle_collisions(self, vel_x, vel_y, solid_map):
+        # Resolve against merged colliders, snapping to the nearest edge met.
+        # Sideways only walls this move ran into count; overlap from before it
+        # (starting half inside the floor) is left to the vertical pass
+        moved = self.rect.copy()
+        reach = math.ceil(abs(vel_x))
+        collisions = solid_map.colliders_in(self.rect)
         for tile in collisions:
-            if vel_x > 0:  # Moving right
-                self.rect.right = tile.rect.left
+            if vel_x > 0 and moved.right - tile.left <= reach:  # Moving right
+                self.rect.right = min(self.rect.right, tile.left)
                 self.velocity.x = 0
-            elif vel_x < 0:  # Moving left
-                self.rect.left = tile.rect.right
+            elif vel_x < 0 and tile.right - moved.left <= reach:  # Moving left
+                self.rect.left = max(self.rect.left, tile.right)
                 self.velocity.x = 0
             
             if vel_y > 0:  # Moving down
-                self.rect.bottom = tile.rect.top
+                self.rect.bottom = min(self.rect.bottom, tile.top)
                 self.velocity.y = 0
                 self.on_ground = True
             elif vel_y < 0:  # Moving up
-                self.rect.top = tile.rect.bottom
+                self.rect.top = max(self.rect.top, tile.bottom)
                 self.velocity.y = 0
-                if hasattr(tile, 'tile_type'):
-                    if tile.tile_type == 'question' and tile.contains_item:
-                        spawn_item(tile.rect.topleft, tile.contains_item)
-                        tile.contains_item = None
-                    elif tile.tile_type == 'brick' and self.state != 'small':
-                        tile.kill()
-                        self.score += 50
+
+        # Every block the head went into gets bumped
+        if vel_y < 0 and collisions:
+            for cell, kind in solid_map.cells_in(moved):
+                if kind == 'question' and solid_map.items.get(cell):
+                    spawn_item(solid_map.cell_rect(cell).topleft, solid_map.items.pop(cell))
+                elif kind == 'brick' and self.state != 'small':
+                    remove_tile(solid_map.cell_rect(cell).topleft)
+                    self.score += 50
 
     def handle_platform_collisions(self, platforms):
-        platform_collisions = pygame.sprite.spritecollide(self, platforms, False)
+        platform_collisions = [platform for platform in platforms if self.rect.colliderect(platform)]
         for platform in platform_collisions:
-            if self.velocity.y > 0 and self.rect.bottom < platform.rect.top + 10:
-                self.rect.bottom = platform.rect.top
+            if self.velocity.y > 0 and self.rect.bottom < platform.top + 10:
+                self.rect.bottom = platform.top
                 self.velocity.y = 0
                 self.on_ground = True
 
     def jump(self):
         if self.on_ground and self.can_jump:
-            jump_power = JUMP_STRENGTH
-            if self.character == 'luigi':
-                jump_power *= 1.1  # Luigi jumps higher
-            elif self.character == 'toad':
-                jump_power *= 0.9  # Toad jumps lower but runs faster
-                
-            self.velocity.y = jump_power
+            # Luigi jumps higher, Toad jumps lower but runs faster
+            self.velocity.y = JUMP_STRENGTH * CHARACTER_JUMP.get(self.character, 1.0)
             self.on_ground = False
             self.can_jump = False
             self.jump_held = True
             self.jump_timer = 0
 
+# Systems: game rules between the player and the world's entities, each run
+# over the world slots of just the entities with the component it handles
+def contact_system(player, hazards):
+    for hazard in world.at(hazards[world.overlapping(player.rect, hazards)]):
+        if player.velocity.y > 0 and player.rect.bottom < hazard.rect.centery:
+            if world.stompable[hazard.slot]:
+                player.velocity.y = -6  # Bounce up
+                player.score += 100
+                hazard.kill()
+        elif not player.invincible:
+            player.hurt()
+
+def collect_coin(player, coin):
+    player.coins_collected += coin.value
+    player.score += 200
+
+def collect_powerup(player, powerup):
+    if powerup.powerup_type == 'mushroom' and player.state == 'small':
+        player.state = 'big'
+        player.score += 1000
+    elif powerup.powerup_type == 'fire_flower' and player.state in ['small', 'big']:
+        player.state = 'fire'
+        player.score += 1000
+    elif powerup.powerup_type == 'star':
+        player.invincible = True
+        player.invincible_timer = 600  # 10 seconds
+        player.score += 1000
+
+PICKUP_EFFECTS = {'coin': collect_coin, 'powerup': collect_powerup}
+
+def pickup_system(player, pickups):
+    for pickup in world.at(pickups[world.overlapping(player.rect, pickups)]):
+        PICKUP_EFFECTS[pickup.kind](player, pickup)
+        pickup.kill()
+
 # Helper functions
 def snap_to_grid(pos, size):
     return (pos[0] // size) * size, (pos[1] // size) * size
 
+def place_tile(pos, tile_type, contains_item=None):
+    cell = tile_map.set(pos, tile_type, contains_item)
+    if cell is None:
+        return None
+    rect = tile_map.cell_rect(cell)
+    static_layer.invalidate_at(rect.topleft)
+    if not level_chunks.quiet:
+        reachability.invalidate_at(rect.topleft)  # Strips streamed in are already known to it
+    level_chunks.mark(rect.topleft)
+    level_bounds.union_ip(rect)
+    dirty.mark(rect)
+    return cell
+
+def remove_tile(pos):
+    record = tile_map.remove(pos)
+    if record is not None:
+        rect = pygame.Rect(record[1], record[2], tile_map.cell_size, tile_map.cell_size)
+        static_layer.invalidate_at(rect.topleft)
+        reachability.invalidate_at(rect.topleft)
+        level_chunks.mark(rect.topleft)
+        dirty.mark(rect)
+    return record
+
+def place_entity(pos, tile_type, variant=None):
+    level_chunks.load_at(pos)
+    if tile_type in TILE_IDS:
+        place_tile(pos, tile_type, 'coin' if tile_type == 'question' else None)  # Coin by default, can be changed
+        return None
+    if tile_type not in ARCHETYPES:
+        return None
+    sprite = world.spawn(tile_type, pos, variant)
+    cell_index.add(sprite)
+    level_bounds.union_ip(sprite.rect)
+    return sprite
+
+def remove_entity_at(pos):
+    # Clears a grid cell, entity first, then tile; returns the record of what
+    # was removed
+    level_chunks.load_at(pos)
+    sprite = cell_index.get(pos)
+    if sprite is not None:
+        record = sprite.record()
+        sprite.kill()
+        return record
+    return remove_tile(pos)
+
+def clear_level():
+    tile_map.clear()
+    reachability.invalidate()
+    cell_index.clear()
+    static_layer.invalidate()
+    level_chunks.clear()
+    world.clear()
+    sprite_layer.clear()
+    level_bounds.size = (WINDOW_WIDTH, WINDOW_HEIGHT)
+    dirty.mark_all()
+
+# What a question block gives out -> the kind of entity spawned
+QUESTION_ITEMS = {'coin': ('coin', None), 'mushroom': ('powerup', 'mushroom')}
+
 def spawn_item(pos, item_type):
-    if item_type == 'coin':
-        coin = Coin(pos)
-        coins_group.add(coin)
-        all_sprites.add(coin)
-    elif item_type == 'mushroom':
-        powerup = PowerUp(pos, 'mushroom')
-        powerups_group.add(powerup)
-        all_sprites.add(powerup)
-
-def save_level(filename="level.json"):
+    if item_type in QUESTION_ITEMS:
+        kind, variant = QUESTION_ITEMS[item_type]
+        world.spawn(kind, pos, variant)
+
+# Binary level format (.mfbl): a fixed header and section table, then a
+# column-major grid of tile ids (one byte per cell, 0 = empty) and packed
+# entity tables. Names (tile, item, enemy, power-up and theme) are stored once
+# and referred to by id. Tiles that are off the grid or share a cell are kept
+# in a separate table so any JSON level converts back unchanged.
+LEVEL_MAGIC = b'MFBL'
+LEVEL_FILES = ["level.mfbl", "level.json"]  # Looked for by the Load button, newest wins
+
+# Incremental saves append the chunks edited since the last save to an edit
+# journal next to the level file (one JSON line per chunk, replacing everything
+# in it). Loading replays the journal over the level; once it grows long enough
+# the next save is a full one, which also drops the journal.
+JOURNAL_SUFFIX = ".journal"
+JOURNAL_MAX_ENTRIES = 256
+AUTOSAVE_SECONDS = 60
+level_file = None        # File the editor's level was last loaded from or saved to
+loaded_file = None       # File the level was loaded from, kept when it's saved elsewhere
+journal_entries = 0
+theme_changed = False
+last_save_ticks = 0
+LEVEL_VERSION = 3
+LEVEL_PREFIX = struct.Struct('<4sH')        # magic, version
+LEVEL_HEADERS = {
+    1: struct.Struct('<4sHHiiIIB'),         # magic, version, cell size, origin col, origin row, cols, rows, theme name id
+    2: struct.Struct('<4sHHiiIIBI'),        # ... then the level's RNG seed
+    3: struct.Struct('<4sHHiiIIBIiiII'),    # ... then the level's bounds: left, top, width, height
+}
+LEVEL_HEADER = LEVEL_HEADERS[LEVEL_VERSION]
+LEVEL_SECTION = struct.Struct('<II')        # offset, record count
+LEVEL_SECTIONS = ['names', 'cells', 'items', 'loose_tiles', 'enemies', 'coins', 'powerups']
+NO_NAME = 255
+ITEM_RECORD = struct.Struct('<IB')          # cell index, item name id
+LOOSE_TILE_RECORD = struct.Struct('<iiBB')  # x, y, tile name id, item name id
+ENEMY_RECORD = struct.Struct('<iiB')        # x, y, enemy type name id
+COIN_RECORD = struct.Struct('<iii')         # x, y, value
+POWERUP_RECORD = struct.Struct('<iiB')      # x, y, power-up type name id
+
+def level_to_bytes(level_data, cell_size=None):
+    cell_size = cell_size or GRID_SIZE
+    names = {}
+
+    def name_id(name):
+        if name is None:
+            return NO_NAME
+        if name not in names:
+            if len(names) == NO_NAME:
+                raise ValueError("Too many distinct names for the binary level format")
+            names[name] = len(names)
+        return names[name]
+
+    theme_id = name_id(level_data.get("theme"))
+
+    grid = {}
+    loose = []
+    for tile in level_data["tiles"]:
+        x, y = tile["x"], tile["y"]
+        cell = (x // cell_size, y // cell_size)
+        if x % cell_size or y % cell_size or cell in grid:
+            loose.append(tile)
+        else:
+            grid[cell] = tile
+
+    if grid:
+        origin_col = min(col for col, row in grid)
+        origin_row = min(row for col, row in grid)
+        cols = max(col for col, row in grid) - origin_col + 1
+        rows = max(row for col, row in grid) - origin_row + 1
+    else:
+        origin_col = origin_row = cols = rows = 0
+
+    cells = bytearray(cols * rows)
+    items = []
+    for (col, row), tile in grid.items():
+        index = (col - origin_col) * rows + (row - origin_row)
+        cells[index] = name_id(tile["type"]) + 1
+        if tile.get("contains_item") is not None:
+            items.append((index, name_id(tile["contains_item"])))
+    items.sort()
+
+    # Entity tables are sorted by position so readers can pick out a range
+    blobs = {
+        'cells': bytes(cells),
+        'items': b''.join(ITEM_RECORD.pack(*item) for item in items),
+        'loose_tiles': b''.join(
+            LOOSE_TILE_RECORD.pack(tile["x"], tile["y"], name_id(tile["type"]), name_id(tile.get("contains_item")))
+            for tile in sorted(loose, key=lambda tile: (tile["x"], tile["y"]))),
+        'enemies': b''.join(
+            ENEMY_RECORD.pack(enemy["x"], enemy["y"], name_id(enemy.get("enemy_type") or "goomba"))
+            for enemy in sorted(level_data["enemies"], key=lambda enemy: (enemy["x"], enemy["y"]))),
+        'coins': b''.join(
+            COIN_RECORD.pack(coin["x"], coin["y"], coin.get("value", 1))
+            for coin in sorted(level_data["coins"], key=lambda coin: (coin["x"], coin["y"]))),
+        'powerups': b''.join(
+            POWERUP_RECORD.pack(powerup["x"], powerup["y"], name_id(powerup.get("powerup_type") or "mushroom"))
+            for powerup in sorted(level_data.get("powerups", []), key=lambda powerup: (powerup["x"], powerup["y"]))),
+    }
+    encoded_names = [name.encode('utf-8') for name in names]
+    blobs['names'] = b''.join(bytes([len(name)]) + name for name in encoded_names)
+    counts = {
+        'names': len(encoded_names),
+        'cells': len(cells),
+        'items': len(items),
+        'loose_tiles': len(loose),
+        'enemies': len(level_data["enemies"]),
+        'coins': len(level_data["coins"]),
+        'powerups': len(level_data.get("powerups", [])),
+    }
+
+    # Everything the level covers, so a mapped reader needn't scan the tables
+    bounds = pygame.Rect(origin_col * cell_size, origin_row * cell_size, cols * cell_size, rows * cell_size)
+    for entry in loose + level_data["enemies"] + level_data["coins"] + level_data.get("powerups", []):
+        bounds.union_ip(pygame.Rect(entry["x"], entry["y"], cell_size, cell_size))
+
+    header = LEVEL_HEADER.pack(LEVEL_MAGIC, LEVEL_VERSION, cell_size, origin_col, origin_row, cols, rows, theme_id,
+                               level_data.get("seed", 0), *bounds)
+    offset = LEVEL_HEADER.size + LEVEL_SECTION.size * len(LEVEL_SECTIONS)
+    table = []
+    for section in LEVEL_SECTIONS:
+        table.append(LEVEL_SECTION.pack(offset, counts[section]))
+        offset += len(blobs[section])
+    return b''.join([header] + table + [blobs[section] for section in LEVEL_SECTIONS])
+
+def read_level_header(data):
+    magic, version = LEVEL_PREFIX.unpack_from(data, 0)
+    if magic != LEVEL_MAGIC:
+        raise ValueError("Not a binary level file")
+    if version not in LEVEL_HEADERS:
+        raise ValueError(f"Level format version {version} is newer than this editor supports")
+    header = LEVEL_HEADERS[version]
+    fields = header.unpack_from(data, 0)
+    cell_size, origin_col, origin_row, cols, rows, theme_id = fields[2:8]
+    seed = fields[8] if version >= 2 else 0
+    bounds = tuple(fields[9:13]) if version >= 3 else None
+    sections = {}
+    for i, section in enumerate(LEVEL_SECTIONS):
+        sections[section] = LEVEL_SECTION.unpack_from(data, header.size + i * LEVEL_SECTION.size)
+    offset, count = sections['names']
+    names = []
+    for _ in range(count):
+        length = data[offset]
+        names.append(bytes(data[offset + 1:offset + 1 + length]).decode('utf-8'))
+        offset += 1 + length
+    return {
+        "cell_size": cell_size,
+        "origin": (origin_col, origin_row),
+        "cols": cols,
+        "rows": rows,
+        "theme": names[theme_id] if theme_id != NO_NAME else None,
+        "seed": seed,
+        "bounds": bounds,
+        "names": names,
+        "sections": sections,
+    }
+
+def read_level_table(data, header, section, record):
+    offset, count = header["sections"][section]
+    return [record.unpack_from(data, offset + i * record.size) for i in range(count)]
+
+def type_name(names, type_id, default):
+    # Enemy and power-up types. Older files stored a missing type as NO_NAME
+    return names[type_id] if type_id < len(names) else default
+
+def level_from_bytes(data):
+    header = read_level_header(data)
+    names = header["names"]
+    cell_size = header["cell_size"]
+    origin_col, origin_row = header["origin"]
+    rows = header["rows"]
+
+    def name_of(name_id):
+        return names[name_id] if name_id != NO_NAME else None
+
+    items = dict(read_level_table(data, header, 'items', ITEM_RECORD))
+    offset, count = header["sections"]['cells']
+    cells = bytes(data[offset:offset + count])
+    tiles = []
+    for index, tile_id in enumerate(cells):
+        if tile_id:
+            col, row = divmod(index, rows)
+            tiles.append({
+                "x": (origin_col + col) * cell_size,
+                "y": (origin_row + row) * cell_size,
+                "type": names[tile_id - 1],
+                "contains_item": name_of(items.get(index, NO_NAME)),
+            })
+    for x, y, type_id, item_id in read_level_table(data, header, 'loose_tiles', LOOSE_TILE_RECORD):
+        tiles.append({"x": x, "y": y, "type": names[type_id], "contains_item": name_of(item_id)})
+
+    return {
+        "tiles": tiles,
+        "enemies": [{"x": x, "y": y, "enemy_type": type_name(names, type_id, "goomba")}
+                    for x, y, type_id in read_level_table(data, header, 'enemies', ENEMY_RECORD)],
+        "coins": [{"x": x, "y": y, "value": value}
+                  for x, y, value in read_level_table(data, header, 'coins', COIN_RECORD)],
+        "powerups": [{"x": x, "y": y, "powerup_type": type_name(names, type_id, "mushroom")}
+                     for x, y, type_id in read_level_table(data, header, 'powerups', POWERUP_RECORD)],
+        "theme": header["theme"] or "Mario Fan Builder Default",
+        "seed": header["seed"],
+    }
+
+def write_level_file(filename, level_data):
+    # The extension picks the format: .mfbl is binary, anything else JSON
+    if filename.endswith('.mfbl'):
+        with open(filename, "wb") as file:
+            file.write(level_to_bytes(level_data))
+    else:
+        with open(filename, "w") as file:
+            json.dump(level_data, file, indent=4)
+
+def read_level_file(filename):
+    # The content picks the format: binary files start with LEVEL_MAGIC
+    with open(filename, "rb") as file:
+        data = file.read()
+    if data.startswith(LEVEL_MAGIC):
+        return level_from_bytes(data)
+    return json.loads(data)
+
+def is_binary_level_file(filename):
+    with open(filename, "rb") as file:
+        return file.read(len(LEVEL_MAGIC)) == LEVEL_MAGIC
+
+def tile_record(tile_type, x, y, contains_item):
+    # Blocks saved empty come back with their default item
+    return (tile_type, x, y, None, contains_item or ('coin' if tile_type == 'question' else None))
+
+# Memory-mapped binary level: only the header and name table are read up front.
+# Grid columns are contiguous in the file and every table is sorted by x, so a
+# horizontal strip of the level is read with a slice and a few binary searches.
+class MappedLevel:
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.header = read_level_header(self.data)
+        self.names = self.header["names"]
+        self.theme = self.header["theme"] or "Mario Fan Builder Default"
+        self.seed = self.header["seed"]
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def _search(self, section, record, key):
+        # Index of the first record whose leading field is >= key
+        offset, count = self.header["sections"][section]
+        low, high = 0, count
+        while low < high:
+            mid = (low + high) // 2
+            if record.unpack_from(self.data, offset + mid * record.size)[0] < key:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def _range(self, section, record, start, stop):
+        offset, count = self.header["sections"][section]
+        for i in range(self._search(section, record, start), count):
+            entry = record.unpack_from(self.data, offset + i * record.size)
+            if entry[0] >= stop:
+                break
+            yield entry
+
+    def bounds(self):
+        if self.header["bounds"] is not None:
+            return pygame.Rect(self.header["bounds"])
+        # Older files don't store them: tables are sorted by x only, so every
+        # record has to be looked at for the y extent (once, then kept)
+        cell_size = self.header["cell_size"]
+        origin_col, origin_row = self.header["origin"]
+        rect = pygame.Rect(origin_col * cell_size, origin_row * cell_size,
+                           self.header["cols"] * cell_size, self.header["rows"] * cell_size)
+        for section, record in (('loose_tiles', LOOSE_TILE_RECORD), ('enemies', ENEMY_RECORD),
+                                ('coins', COIN_RECORD), ('powerups', POWERUP_RECORD)):
+            offset, count = self.header["sections"][section]
+            for i in range(count):
+                x, y = record.unpack_from(self.data, offset + i * record.size)[:2]
+                rect.union_ip(pygame.Rect(x, y, cell_size, cell_size))
+        self.header["bounds"] = tuple(rect)
+        return rect
+
+    def records_between(self, left, right):
+        # Compact records for everything whose x is in [left, right)
+        names = self.names
+        cell_size = self.header["cell_size"]
+        origin_col, origin_row = self.header["origin"]
+        rows = self.header["rows"]
+        col_start = max(-(-left // cell_size) - origin_col, 0)
+        col_end = min(-(-right // cell_size) - origin_col, self.header["cols"])
+        if col_start < col_end:
+            first, last = col_start * rows, col_end * rows
+            items = dict(self._range('items', ITEM_RECORD, first, last))
+            offset = self.header["sections"]['cells'][0]
+            cells = self.data[offset + first:offset + last]
+            for index, tile_id in enumerate(cells, first):
+                if tile_id:
+                    col, row = divmod(index, rows)
+                    item_id = items.get(index, NO_NAME)
+                    yield tile_record(names[tile_id - 1], (origin_col + col) * cell_size,
+                                      (origin_row + row) * cell_size,
+                                      names[item_id] if item_id != NO_NAME else None)
+        for x, y, type_id, item_id in self._range('loose_tiles', LOOSE_TILE_RECORD, left, right):
+            yield tile_record(names[type_id], x, y, names[item_id] if item_id != NO_NAME else None)
+        for x, y, type_id in self._range('enemies', ENEMY_RECORD, left, right):
+            yield ('enemy', x, y, type_name(names, type_id, 'goomba'), None)
+        for x, y, value in self._range('coins', COIN_RECORD, left, right):
+            yield ('coin', x, y, None, value)
+        for x, y, type_id in self._range('powerups', POWERUP_RECORD, left, right):
+            yield ('powerup', x, y, type_name(names, type_id, 'mushroom'), None)
+
+def convert_level(source, destination):
+    write_level_file(destination, read_level_file(source))
+
+def level_records():
+    # Every tile and entity in the level, live or not, as a compact record
+    yield from tile_map.records()
+    for sprite in world.entities:
+        yield sprite.record()
+    yield from level_chunks.cold_records()
+
+def default_level_file():
+    # The most recently saved of level.mfbl / level.json
+    existing = [name for name in LEVEL_FILES if os.path.exists(name)]
+    return max(existing, key=os.path.getmtime) if existing else LEVEL_FILES[-1]
+
+# Background level I/O: the main thread only takes a snapshot of the level (or
+# applies a parsed one a batch at a time); encoding, decoding and file access
+# run on one worker thread, in submission order, which posts LEVEL_IO_DONE
+LEVEL_IO_DONE = pygame.USEREVENT + 1
+LOAD_BUDGET_MS = 4  # Time spent handing records to the level per frame while loading
+LOAD_CHECK_RECORDS = 256  # Records between looks at the clock
+pending_load = None
+
+class LevelIO:
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.thread = None
+
+    def submit(self, kind, filename, work):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        self.jobs.put((kind, filename, work))
+
+    def run(self):
+        while True:
+            kind, filename, work = self.jobs.get()
+            try:
+                result, error = work(), None
+            except Exception as e:
+                result, error = None, e
+            pygame.event.post(pygame.event.Event(LEVEL_IO_DONE, kind=kind, filename=filename,
+                                                 result=result, error=error))
+            self.jobs.task_done()
+
+    def finish(self):
+        # Let queued saves reach the disk before the process exits
+        self.jobs.join()
+
+level_io = LevelIO()
+
+def snapshot_level():
+    # Records of the tiles and live sprites, the cold record lists, and the
+    # strips of a mapped level that were never read (the worker maps the file
+    # itself)
+    records = tile_map.records()
+    records.extend(sprite.record() for sprite in world.entities)
+    for cold in level_chunks.cold.values():
+        records.extend(cold)
+    unread = None
+    if level_chunks.source is not None:
+        size = level_chunks.chunk_size
+        unread = (level_chunks.source.filename,
+                  [(chunk_x * size, (chunk_x + 1) * size) for chunk_x in level_chunks.unread_strips()])
+    return current_theme, level_seed, records, unread
+
+def level_data_from_records(theme, seed, records):
     level_data = {
         "tiles": [],
         "enemies": [],
         "coins": [],
         "powerups": [],
-        "theme": current_theme
+        "theme": theme,
+        "seed": seed
     }
-    for tile in tiles_group:
-        tile_data = {
-            "x": tile.rect.x,
-            "y": tile.rect.y,
-            "type": tile.tile_type,
-            "contains_item": tile.contains_item if hasattr(tile, 'contains_item') else None
-        }
-        level_data["tiles"].append(tile_data)
-    for enemy in enemies_group:
-        enemy_data = {
-            "x": enemy.rect.x,
-            "y": enemy.rect.y,
-            "enemy_type": enemy.enemy_type if hasattr(enemy, 'enemy_type') else 'goomba'
-        }
-        level_data["enemies"].append(enemy_data)
-    for coin in coins_group:
-        coin_data = {
-            "x": coin.rect.x,
-            "y": coin.rect.y,
-            "value": coin.value if hasattr(coin, 'value') else 1
-        }
-        level_data["coins"].append(coin_data)
-    for powerup in powerups_group:
-        powerup_data = {
-            "x": powerup.rect.x,
-            "y": powerup.rect.y,
-            "powerup_type": powerup.powerup_type
-        }
-        level_data["powerups"].append(powerup_data)
+    for tile_type, x, y, variant, extra in records:
+        if tile_type == 'enemy':
+            level_data["enemies"].append({"x": x, "y": y, "enemy_type": variant})
+        elif tile_type == 'coin':
+            level_data["coins"].append({"x": x, "y": y, "value": extra})
+        elif tile_type == 'powerup':
+            level_data["powerups"].append({"x": x, "y": y, "powerup_type": variant})
+        else:
+            level_data["tiles"].append({"x": x, "y": y, "type": tile_type, "contains_item": extra})
+    return level_data
+
+def write_snapshot(filename, snapshot):
+    theme, seed, records, unread = snapshot
+    if unread is not None:
+        source = MappedLevel(unread[0])
+        try:
+            for left, right in unread[1]:
+                records.extend(source.records_between(left, right))
+        finally:
+            source.close()
+    write_level_file(filename, level_data_from_records(theme, seed, records))
+    journal = filename + JOURNAL_SUFFIX
+    if os.path.exists(journal):
+        os.remove(journal)
+
+def save_level(filename="level.json", background=False):
+    global level_file
+    if pending_load is not None:
+        print("Level is still loading.")
+        return
+    source = level_chunks.source
+    if source is not None and os.path.abspath(source.filename) == os.path.abspath(filename):
+        level_chunks.detach()  # Don't rewrite a file that is still mapped
+    if (tile_map.skipped and loaded_file is not None
+            and os.path.abspath(loaded_file) == os.path.abspath(filename)):
+        # Writing the level back would delete the tiles it couldn't load
+        level_file = None  # Stops autosave retrying
+        print(f"Not saving over {filename}: {tile_map.skipped} of its tiles lie left of or above "
+              f"the level and weren't loaded. Save it under another name.")
+        return
+    snapshot = snapshot_level()
+    mark_saved(filename, 0)
+    if background:
+        level_io.submit('save', filename, lambda: write_snapshot(filename, snapshot))
+        return
     try:
-        with open(filename, "w") as file:
-            json.dump(level_data, file, indent=4)
+        write_snapshot(filename, snapshot)
         print(f"Level saved to {filename}.")
     except Exception as e:
+        level_chunks.dirty_all = True
         print(f"Error saving level: {e}")
 
-def load_level(filename="level.json"):
-    global current_theme
+def mark_saved(filename, entries):
+    global level_file, journal_entries, theme_changed, last_save_ticks
+    level_file = filename
+    journal_entries = entries
+    theme_changed = False
+    last_save_ticks = pygame.time.get_ticks()
+    level_chunks.dirty.clear()
+    level_chunks.dirty_all = False
+
+def journal_stamp(filename):
+    # Ties a journal to the exact level file it was written against
+    stat = os.stat(filename)
+    return {"base_size": stat.st_size, "base_mtime_ns": stat.st_mtime_ns}
+
+def append_journal(filename, entries):
+    journal = filename + JOURNAL_SUFFIX
+    lines = [json.dumps(entry) for entry in entries]
+    if not os.path.exists(journal):
+        lines.insert(0, json.dumps(journal_stamp(filename)))
+    with open(journal, "a") as file:
+        file.write("\n".join(lines) + "\n")
+
+def save_level_incremental(filename=None, background=False):
+    if pending_load is not None:
+        print("Level is still loading.")
+        return
+    filename = filename or level_file or "level.json"
+    if (filename != level_file or level_chunks.dirty_all or not os.path.exists(filename)
+            or journal_entries >= JOURNAL_MAX_ENTRIES):
+        save_level(filename, background)  # Nothing to append to, or time to compact
+        return
+    if not level_chunks.dirty and not theme_changed:
+        return
+    entries = []
+    if theme_changed:
+        entries.append({"theme": current_theme})
+    size = level_chunks.chunk_size
+    for key in sorted(level_chunks.dirty):
+        origin = level_chunks.chunk_origin(key)
+        entries.append({"region": [origin[0], origin[1], size],
+                        "records": level_chunks.region_records(key)})
+    mark_saved(filename, journal_entries + len(entries))
+    if background:
+        level_io.submit('journal', filename, lambda: append_journal(filename, entries))
+        return
     try:
-        with open(filename, "r") as file:
-            level_data = json.load(file)
-            theme = level_data.get("theme", "Mario Fan Builder Default")
-            set_theme(theme)
-            tiles_group.empty()
-            enemies_group.empty()
-            coins_group.empty()
-            powerups_group.empty()
-            all_sprites.empty()
-            all_sprites.add(player)
-
-            for tile_data in level_data["tiles"]:
-                tile = Tile((tile_data["x"], tile_data["y"]), tile_data["type"])
-                if "contains_item" in tile_data and tile_data["contains_item"]:
-                    tile.contains_item = tile_data["contains_item"]
-                tiles_group.add(tile)
-                all_sprites.add(tile)
-
-            for enemy_data in level_data["enemies"]:
-                enemy_type = enemy_data.get("enemy_type", "goomba")
-                enemy = Enemy((enemy_data["x"], enemy_data["y"]), enemy_type)
-                enemies_group.add(enemy)
-                all_sprites.add(enemy)
-
-            for coin_data in level_data["coins"]:
-                coin = Coin((coin_data["x"], coin_data["y"]))
-                if "value" in coin_data:
-                    coin.value = coin_data["value"]
-                coins_group.add(coin)
-                all_sprites.add(coin)
-                
-            if "powerups" in level_data:
-                for powerup_data in level_data["powerups"]:
-                    powerup_type = powerup_data.get("powerup_type", "mushroom")
-                    powerup = PowerUp((powerup_data["x"], powerup_data["y"]), powerup_type)
-                    powerups_group.add(powerup)
-                    all_sprites.add(powerup)
-        print(f"Level loaded from {filename}.")
+        append_journal(filename, entries)
+        print(f"Edits journaled to {filename}{JOURNAL_SUFFIX} ({len(entries)} entries).")
+    except Exception as e:
+        level_chunks.dirty_all = True
+        print(f"Error saving level: {e}")
+
+def read_journal(filename):
+    journal = filename + JOURNAL_SUFFIX
+    if not os.path.exists(journal):
+        return []
+    with open(journal, "r") as file:
+        lines = file.read().splitlines()
+    if not lines or json.loads(lines[0]) != journal_stamp(filename):
+        # The level file was rewritten without it; its edits are already lost
+        print(f"Ignoring stale journal {journal}.")
+        os.remove(journal)
+        return []
+    return [json.loads(line) for line in lines[1:]]
+
+def replay_journal(entries):
+    for entry in entries:
+        if "theme" in entry:
+            set_theme(entry["theme"])
+        else:
+            left, top, size = entry["region"]
+            level_chunks.replace_region(pygame.Rect(left, top, size, size),
+                                        [tuple(record) for record in entry["records"]])
+
+def read_level_records(filename):
+    # Worker side of a load: everything but touching the level itself.
+    # Binary levels are mapped by the main thread, so only the journal is read
+    if is_binary_level_file(filename):
+        return None, None, None, read_journal(filename)
+    level_data = read_level_file(filename)
+    records = [tile_record(tile_data["type"], tile_data["x"], tile_data["y"], tile_data.get("contains_item"))
+               for tile_data in level_data["tiles"]]
+    records.extend(('enemy', enemy_data["x"], enemy_data["y"], enemy_data.get("enemy_type") or "goomba", None)
+                   for enemy_data in level_data["enemies"])
+    records.extend(('coin', coin_data["x"], coin_data["y"], None, coin_data.get("value", 1))
+                   for coin_data in level_data["coins"])
+    records.extend(('powerup', powerup_data["x"], powerup_data["y"],
+                    powerup_data.get("powerup_type") or "mushroom", None)
+                   for powerup_data in level_data.get("powerups", []))
+    return (level_data.get("theme", "Mario Fan Builder Default"), level_data.get("seed", 0),
+            records, read_journal(filename))
+
+def begin_load(filename, result):
+    global pending_load, level_seed, loaded_file
+    theme, seed, records, journal = result
+    if records is None:
+        # Mapped, not read: strips are pulled in as the camera reaches them
+        source = MappedLevel(filename)
+        set_theme(source.theme)
+        clear_level()
+        level_chunks.attach(source)
+        level_seed = source.seed
+        records = []
+    else:
+        set_theme(theme)
+        clear_level()
+        level_seed = seed
+    # Loading isn't editing: nothing is marked until the load is done, and
+    # edits to the level it replaces can't be undone into it
+    undo_stack.clear()
+    redo_stack.clear()
+    level_chunks.quiet = True
+    dirty.paused = True
+    loaded_file = filename
+    pending_load = (filename, iter(records), journal)
+
+def step_load(budget_ms=LOAD_BUDGET_MS):
+    # Hand records to the level for up to budget_ms; True once the load is done
+    global pending_load
+    filename, records, journal = pending_load
+    deadline = time.perf_counter() + budget_ms / 1000
+    count = 0
+    for record in records:
+        level_chunks.store(record)
+        count += 1
+        if count % LOAD_CHECK_RECORDS == 0 and time.perf_counter() >= deadline:
+            return False
+    pending_load = None
+    replay_journal(journal)
+    level_chunks.quiet = False
+    dirty.paused = False
+    dirty.mark_all()
+    mark_saved(filename, len(journal))
+    level_chunks.update(camera.active_rect())
+    print(f"Level loaded from {filename}.")
+    if tile_map.skipped:
+        print(f"{tile_map.skipped} tiles left of or above the level were skipped; "
+              f"{filename} won't be saved over.")
+    return True
+
+def load_level(filename=None, background=False):
+    filename = filename or default_level_file()
+    if background:
+        level_io.submit('load', filename, lambda: read_level_records(filename))
+        return
+    try:
+        begin_load(filename, read_level_records(filename))
+        while not step_load():
+            pass
     except FileNotFoundError:
         print(f"File {filename} not found.")
     except Exception as e:
         print(f"Error loading level: {e}")
 
+def finish_level_io(event):
+    if event.error is not None:
+        if event.kind in ('save', 'journal'):
+            level_chunks.dirty_all = True  # The next save has to be a full one
+            print(f"Error saving level: {event.error}")
+        elif isinstance(event.error, FileNotFoundError):
+            print(f"File {event.filename} not found.")
+        else:
+            print(f"Error loading level: {event.error}")
+    elif event.kind == 'save':
+        print(f"Level saved to {event.filename}.")
+    elif event.kind == 'journal':
+        print(f"Edits journaled to {event.filename}{JOURNAL_SUFFIX}.")
+    else:
+        try:
+            begin_load(event.filename, event.result)
+        except Exception as e:
+            print(f"Error loading level: {e}")
+
 def set_theme(theme_name):
-    global current_theme
+    global current_theme, theme_changed
     if theme_name in themes:
         current_theme = theme_name
-        for sprite in all_sprites:
-            if isinstance(sprite, Tile):
-                sprite.update_image()
-            elif isinstance(sprite, Enemy):
-                sprite.image.fill(themes[current_theme]['enemy'])
-            elif isinstance(sprite, Coin):
-                sprite.draw_coin()
+        theme_changed = True
+        for sprite in world.entities:
+            sprite.update_image()
+        static_layer.invalidate()
+        dirty.mark_all()
         print(f"Theme set to '{theme_name}'.")
     else:
         print(f"Theme '{theme_name}' does not exist.")
 
+# Template characters -> (placement type, variant)
+construct_legend = {
+    'G': ('ground', None),         # Ground
+    'B': ('brick', None),          # Brick
+    'Q': ('question', None),       # Question block (coin by default)
+    'C': ('coin', None),           # Coin
+    'E': ('enemy', 'goomba'),      # Enemy (Goomba by default)
+    'K': ('enemy', 'koopa'),       # Koopa
+    'W': ('water', None),          # Water
+    'P': ('pipe', None),           # Pipe
+    'M': ('powerup', 'mushroom'),  # Mushroom
+    'F': ('powerup', 'fire_flower'),  # Fire Flower
+    'S': ('powerup', 'star'),      # Star
+    '-': ('platform', None),       # Platform
+}
+
 def load_construct_level(level_data, theme_name='Mario Fan Builder Default'):
+    global level_file, level_seed, loaded_file
     set_theme(theme_name)
-    tiles_group.empty()
-    enemies_group.empty()
-    coins_group.empty()
-    powerups_group.empty()
-    all_sprites.empty()
-    all_sprites.add(player)
+    clear_level()
+    level_file = None  # A new level: no autosave until it is saved somewhere
+    loaded_file = None
+    level_seed = 0
 
     for y, row in enumerate(level_data):
         for x, char in enumerate(row):
-            pos = (x * GRID_SIZE, y * GRID_SIZE)
-            if char == 'G':  # Ground
-                tile = Tile(pos, 'ground')
-                tiles_group.add(tile)
-                all_sprites.add(tile)
-            elif char == 'B':  # Brick
-                tile = Tile(pos, 'brick')
-                tiles_group.add(tile)
-                all_sprites.add(tile)
-            elif char == 'Q':  # Question block
-                tile = Tile(pos, 'question')
-                tile.contains_item = 'coin'  # Default item
-                tiles_group.add(tile)
-                all_sprites.add(tile)
-            elif char == 'C':  # Coin
-                coin = Coin(pos)
-                coins_group.add(coin)
-                all_sprites.add(coin)
-            elif char == 'E':  # Enemy (Goomba by default)
-                enemy = Enemy(pos, 'goomba')
-                enemies_group.add(enemy)
-                all_sprites.add(enemy)
-            elif char == 'K':  # Koopa
-                enemy = Enemy(pos, 'koopa')
-                enemies_group.add(enemy)
-                all_sprites.add(enemy)
-            elif char == 'W':  # Water
-                tile = Tile(pos, 'water')
-                tiles_group.add(tile)
-                all_sprites.add(tile)
-            elif char == 'P':  # Pipe
-                tile = Tile(pos, 'pipe')
-                tiles_group.add(tile)
-                all_sprites.add(tile)
-            elif char == 'M':  # Mushroom
-                powerup = PowerUp(pos, 'mushroom')
-                powerups_group.add(powerup)
-                all_sprites.add(powerup)
-            elif char == 'F':  # Fire Flower
-                powerup = PowerUp(pos, 'fire_flower')
-                powerups_group.add(powerup)
-                all_sprites.add(powerup)
-            elif char == 'S':  # Star
-                powerup = PowerUp(pos, 'star')
-                powerups_group.add(powerup)
-                all_sprites.add(powerup)
-            elif char == '-':  # Platform
-                tile = Tile(pos, 'platform')
-                platforms_group.add(tile)
-                all_sprites.add(tile)
+            if char in construct_legend:
+                tile_type, variant = construct_legend[char]
+                place_entity((x * GRID_SIZE, y * GRID_SIZE), tile_type, variant)
     print("Mario Fan Builder level loaded.")
 
+PLAYER_START = (400, WINDOW_HEIGHT - GRID_SIZE)  # Player center when a playtest starts
+
+def start_playtest():
+    global playtest_mode
+    playtest_mode = True
+    rng.reset(level_seed)
+    camera.save()
+    player.reset(PLAYER_START)
+    camera.follow(player.rect, level_bounds)  # The first tick simulates around the player
+    print("Playtest mode started. Use arrow keys to move, Space to jump, Shift to run.")
+
+def level_completed():
+    return player.rect.right >= level_bounds.right - GRID_SIZE
+
 def playtest_reset():
     global playtest_mode
-    player.rect.center = (400, WINDOW_HEIGHT - GRID_SIZE)
+    player.rect.center = PLAYER_START
     player.velocity = pygame.Vector2(0, 0)
-    player.state = 'small'
-    player.coins_collected = 0
-    player.score = 0
+    player.state = 'small'  # Coins and score stay readable until the next start
     player.invincible = False
     player.p_meter = 0
     playtest_mode = False
+    camera.restore()
     print("Playtest mode ended. Back to editor.")
 
-# Initialize sprite groups
-tiles_group = pygame.sprite.Group()
-enemies_group = pygame.sprite.Group()
-coins_group = pygame.sprite.Group()
-powerups_group = pygame.sprite.Group()
-platforms_group = pygame.sprite.Group()
-all_sprites = pygame.sprite.Group()
+# Static reachability: which grid cells the player can get to from the start,
+# worked out from precomputed jump arcs instead of frame-by-frame simulation.
+# Cells are tracked one column at a time as bit masks, bit n for row n. The
+# analysis is optimistic (running start, jump held, no enemies), so a level it
+# flags can't be beaten, while one it passes may still be too hard.
+# The tile masks are kept up to date as tiles change, and the search visits
+# standing spots left to right, saving its state every few columns. A jump only
+# spans so many columns, so after an edit the search resumes from the last
+# saved state a jump's width left of the leftmost edited column
+REACH_CHECK_MS = 250  # Least time between live re-checks in the editor
+REACH_CHECKPOINT_COLS = 64
+
+class Reachability:
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.envelopes = {}
+        self.reached = []          # Per column, mask of the rows the player can be in
+        self.goal_reachable = True
+        self.frontier = 0          # Right edge of the furthest column reached
+        self.key = None            # (edits, character) the result is for
+        self.checked_ticks = 0
+        self.solid = None          # Per column, mask of solid tiles; None until read
+        self.ledge = []            # Solid or platform: something to stand on
+        self.free = []
+        self.stand = []            # Free cells with something to stand on below
+        self.rows = 0              # Rows free and stand were worked out for
+        self.edited = set()        # Columns whose tiles changed since the last analysis
+        self.setup = None          # What the last search started from
+        self.stood = []
+        self.log = []              # (col, reached, stood) before each change, to roll back
+        self.checkpoints = []      # (col, log length, queue) as the search got to col
+
+    def reset(self, cell_size):
+        # After the grid or the physics settings change: nothing cached still holds
+        self.cell_size = cell_size
+        self.envelopes.clear()
+        self.key = None
+        self.invalidate()
+
+    def invalidate(self):
+        # Any tile may have changed: read every column again
+        self.solid = None
+        self.setup = None
+
+    def invalidate_at(self, pos):
+        if self.solid is not None and pos[0] >= 0:
+            self.edited.add(pos[0] // self.cell_size)
+
+    def read_columns(self, columns):
+        # Tile masks of the given columns, from the tile map and from any strips
+        # of a mapped level that haven't been read into it yet
+        inside = [col for col in columns if col < tile_map.cols]
+        if inside and tile_map.rows and tile_map.cell_size == self.cell_size:
+            ids = tile_map.ids.reshape(tile_map.rows, tile_map.cols)[:, inside]
+            solid = SOLID_IDS[ids]
+            solid_bytes = np.packbits(solid, axis=0, bitorder='little').T
+            ledge_bytes = np.packbits(solid | (ids == TILE_IDS['platform']), axis=0, bitorder='little').T
+            for col, solid_mask, ledge_mask in zip(inside, solid_bytes, ledge_bytes):
+                self.solid[col] = int.from_bytes(solid_mask.tobytes(), 'little')
+                self.ledge[col] = int.from_bytes(ledge_mask.tobytes(), 'little')
+        else:
+            for col in inside:
+                self.solid[col] = self.ledge[col] = 0
+        for col in columns[len(inside):]:
+            self.solid[col] = self.ledge[col] = 0
+        source = level_chunks.source
+        if source is None:
+            return
+        size, chunk_size = self.cell_size, level_chunks.chunk_size
+        wanted = set(columns)
+        strips = {col * size // chunk_size for col in columns} - level_chunks.read_strips
+        for chunk_x in sorted(strips):
+            for tile_type, x, y, variant, extra in source.records_between(chunk_x * chunk_size,
+                                                                          (chunk_x + 1) * chunk_size):
+                col, row = x // size, y // size
+                if col in wanted and row >= 0 and (tile_type in SOLID_TILE_TYPES or tile_type == 'platform'):
+                    self.ledge[col] |= 1 << row
+                    if tile_type != 'platform':
+                        self.solid[col] |= 1 << row
+
+    def update_masks(self, cols, rows):
+        # Bring the masks up to date; returns the leftmost column that changed
+        if self.solid is None:
+            self.solid, self.ledge = [0] * cols, [0] * cols
+            changed = list(range(cols))
+        else:
+            known = len(self.solid)
+            if cols > known:
+                self.solid.extend([0] * (cols - known))
+                self.ledge.extend([0] * (cols - known))
+            changed = sorted({col for col in self.edited if col < known} | set(range(known, cols)))
+        self.edited = set()
+        if changed:
+            self.read_columns(changed)
+        full = (1 << rows) - 1
+        floor = 1 << (rows - 1)  # The player lands on level_bounds.bottom
+        if rows != self.rows or len(self.free) < len(self.solid):
+            self.rows = rows
+            self.free = [full & ~mask for mask in self.solid]
+            self.stand = [free & ((ledge >> 1) | floor) for free, ledge in zip(self.free, self.ledge)]
+        else:
+            for col in changed:
+                self.free[col] = full & ~self.solid[col]
+                self.stand[col] = self.free[col] & ((self.ledge[col] >> 1) | floor)
+        return changed[0] if changed else None
+
+    def envelope(self, character, rows, hold):
+        # Entry k: how many cells above its take-off row the player can still be
+        # once it has moved k columns across. Follows the jump in Player.jump and
+        # the hold/gravity steps of Player.update, jump held throughout, at
+        # RUN_SPEED_MAX. Holding jump on landing takes off at full JUMP_STRENGTH,
+        # so the weaker press jump never limits
+        key = (character, rows, hold, self.cell_size, JUMP_STRENGTH, RUN_SPEED_MAX, GRAVITY, TERMINAL_VELOCITY)
+        if key in self.envelopes:
+            return self.envelopes[key]
+        size = self.cell_size
+        vy = min(JUMP_STRENGTH, JUMP_STRENGTH * CHARACTER_JUMP.get(character, 1.0))
+        gravity = GRAVITY * FLOAT_GRAVITY.get(character, CHARACTER_GRAVITY.get(character, 1.0))
+        heights = []
+        height = 0
+        while height > -(rows + 1) * size:
+            if 0 < len(heights) < hold:
+                vy = min(vy, JUMP_STRENGTH * 0.5)
+            vy = min(vy + gravity, TERMINAL_VELOCITY)
+            height -= vy
+            heights.append(height)
+        # Highest point still ahead after each tick, then sampled per column
+        for tick in range(len(heights) - 2, -1, -1):
+            heights[tick] = max(heights[tick], heights[tick + 1])
+        envelope = []
+        for cols in range(len(heights)):
+            tick = max(math.ceil(cols * size / RUN_SPEED_MAX) - 1, 0)
+            if tick >= len(heights):
+                break
+            envelope.append(int(heights[tick] // size))
+        self.envelopes[key] = envelope
+        return envelope
+
+    def analyze(self, bounds, start, character, hold):
+        size = self.cell_size
+        cols = max(-(-bounds.right // size), 1)
+        rows = max(-(-bounds.bottom // size), 1)
+        full = (1 << rows) - 1
+        changed = self.update_masks(cols, rows)
+        envelope = self.envelope(character, rows, hold)
+        free, stand = self.free, self.stand
+
+        def spread(mask, col, allowed):
+            # Fall through free cells until landing, or rise within the arc
+            while True:
+                grown = (mask | (((mask & ~stand[col]) << 1) & free[col])
+                         | ((mask >> 1) & free[col] & allowed))
+                if grown == mask:
+                    return mask
+                mask = grown
+
+        start_col = min(max(start[0] // size, 0), cols - 1)
+        setup = (rows, start_col, start[1] // size, character, hold, envelope)
+        resume = None
+        if setup == self.setup:
+            if len(self.reached) != cols:
+                # Jumps near the old right edge were cut short there
+                changed = min(len(self.reached), cols, cols if changed is None else changed)
+            if changed is None:
+                return self.goal_reachable
+            # Searching from spots a jump's width left of the edit never got to it
+            last = changed - (len(envelope) - 1)
+            resume = next((checkpoint for checkpoint in reversed(self.checkpoints)
+                           if start_col < checkpoint[0] <= last), None)
+        self.setup = setup
+
+        if resume is None:
+            reached, stood, log, checkpoints = [0] * cols, [0] * cols, [], []
+            queue = []
+            col = start_col
+            row = min(max(start[1] // size, 0), rows - 1)
+            while row > 0 and not free[col] >> row & 1:
+                row -= 1  # Starting inside the ground: pushed up out of it, as in handle_collisions
+            landed = spread((1 << row) & free[col], col, 0) & stand[col]
+            if landed:
+                stood[col] = landed
+                queue.append((col, landed.bit_length() - 1))
+            next_checkpoint = REACH_CHECKPOINT_COLS
+        else:
+            reached, stood, log = self.reached, self.stood, self.log
+            checkpoint_col, logged, queue = resume
+            while len(log) > logged:
+                col, reached[col], stood[col] = log.pop()
+            checkpoints = self.checkpoints[:self.checkpoints.index(resume) + 1]
+            del reached[cols:], stood[cols:]
+            reached.extend([0] * (cols - len(reached)))
+            stood.extend([0] * (cols - len(stood)))
+            queue = list(queue)
+            next_checkpoint = checkpoint_col + REACH_CHECKPOINT_COLS
+
+        # Standing spots are taken leftmost first, so everything before a
+        # checkpoint only ever looked at columns short of it plus one jump
+        while queue:
+            if queue[0][0] >= next_checkpoint:
+                saved = list(queue)
+                while queue[0][0] >= next_checkpoint:
+                    checkpoints.append((next_checkpoint, len(log), saved))
+                    next_checkpoint += REACH_CHECKPOINT_COLS
+            col, row = heapq.heappop(queue)
+            for step in (1, -1):
+                mask = 1 << row
+                for k, top in enumerate(envelope):
+                    c = col + step * k
+                    top_row = row - top
+                    if not 0 <= c < cols or top_row >= rows:
+                        break
+                    allowed = full & ~((1 << max(top_row, 0)) - 1)
+                    mask = spread(mask & free[c] & allowed, c, allowed)
+                    if not mask:
+                        break
+                    new = mask & stand[c] & ~stood[c]
+                    if new or mask & ~reached[c]:
+                        log.append((c, reached[c], stood[c]))
+                        reached[c] |= mask
+                        stood[c] |= new
+                    while new:
+                        low = new & -new
+                        heapq.heappush(queue, (c, low.bit_length() - 1))
+                        new ^= low
+
+        self.reached, self.stood, self.log, self.checkpoints = reached, stood, log, checkpoints
+        furthest = next((col for col in range(cols - 1, -1, -1) if reached[col]), -1)
+        self.frontier = (furthest + 1) * size
+        # level_completed() wants the player's right edge within a cell of the end
+        self.goal_reachable = furthest >= cols - 2
+        return self.goal_reachable
+
+    def reachable(self, pos):
+        col, row = pos[0] // self.cell_size, pos[1] // self.cell_size
+        return 0 <= col < len(self.reached) and row >= 0 and bool(self.reached[col] >> row & 1)
+
+# Initialize the level's indexes and entity world
+sprite_layer = SpatialBuckets()  # Everything drawn per sprite, i.e. not baked into static_layer
+tile_map = TileMap(GRID_SIZE)
+cell_index = CellIndex(GRID_SIZE)  # Entities only; tiles are looked up in tile_map
+static_layer = StaticTileLayer(tile_map)
+level_chunks = LevelChunks(GRID_SIZE)
+world = World({'sprite': sprite_layer})
 
 # Create the player
-player = Player((400, WINDOW_HEIGHT - GRID_SIZE))
-all_sprites.add(player)
+player = Player(PLAYER_START)
+reachability = Reachability(GRID_SIZE)
+
+def check_reachability():
+    start = pygame.Rect(0, 0, GRID_SIZE, GRID_SIZE)
+    start.center = PLAYER_START
+    reachability.analyze(level_bounds, start.topleft, player.character, player.max_jump_hold)
+    reachability.key = (level_chunks.edits, player.character)
+    reachability.checked_ticks = pygame.time.get_ticks()
+    return reachability.goal_reachable
+
+# The level grows past the window to fit whatever is placed in it
+level_bounds = pygame.Rect(0, 0, WINDOW_WIDTH, WINDOW_HEIGHT)
 
 # HUD Setup
 HUD_RECT = pygame.Rect(0, WINDOW_HEIGHT, WINDOW_WIDTH, HUD_HEIGHT)
+WORLD_VIEW = pygame.Rect(0, 0, WINDOW_WIDTH, WINDOW_HEIGHT)
+camera = Camera(WORLD_VIEW)
+dirty.camera = camera
+FPS_RECT = pygame.Rect(WINDOW_WIDTH - 100, 10, 100, 20)
 
-# Define tile types and their icons
+# Define tile types (icons come from the atlas so they follow the theme)
 tile_types = ['ground', 'brick', 'question', 'pipe', 'platform', 'water', 'enemy', 'coin', 'powerup']
-tile_icons = {}
-
-for index, tile_type in enumerate(tile_types):
-    icon = pygame.Surface((40, 40), pygame.SRCALPHA)
-    theme_colors = themes[current_theme]
-    if tile_type in theme_colors:
-        icon.fill(theme_colors[tile_type])
-    elif tile_type == 'coin':
-        pygame.draw.circle(icon, themes[current_theme]['coin'], (20, 20), 15)
-    elif tile_type == 'enemy':
-        icon.fill(themes[current_theme]['enemy'])
-    elif tile_type == 'platform':
-        icon.fill((100, 100, 100, 150))
-        pygame.draw.rect(icon, theme_colors.get('ground'), (0, 0, 40, 10))
-    else:
-        icon.fill(WHITE)
-    tile_icons[tile_type] = icon
+ICON_SIZE = 40
 
 # HUD buttons positions
 button_positions = {}
@@ -803,6 +2597,154 @@ buttons = {
     "settings": pygame.Rect(840, WINDOW_HEIGHT + 10, 150, 30),
     "quit": pygame.Rect(840, WINDOW_HEIGHT + 50, 150, 30),
 }
+button_labels = {
+    "save": "Save",
+    "load": "Load",
+    "load_construct": "Load Template",
+    "playtest": "Playtest",
+    "settings": "Settings",
+    "quit": "Quit",
+}
+
+# Cached text: each (text, color) is rendered once and reused until evicted
+class TextCache:
+    def __init__(self, font, max_entries=256):
+        self.font = font
+        self.max_entries = max_entries
+        self.surfaces = OrderedDict()
+
+    def render(self, text, color):
+        key = (text, color)
+        surface = self.surfaces.get(key)
+        if surface is None:
+            surface = self.surfaces[key] = self.font.render(text, True, color)
+            if len(self.surfaces) > self.max_entries:
+                self.surfaces.popitem(last=False)
+        else:
+            self.surfaces.move_to_end(key)
+        return surface
+
+text_cache = TextCache(FONT)
+
+# Editor grid, rendered into one overlay surface per grid size and viewport
+# (one cell larger than the viewport, so scrolling is just an offset blit)
+class GridOverlay:
+    def __init__(self, cell_size, viewport, color=GRAY):
+        self.viewport = viewport
+        self.color = color
+        self.surface = None
+        self.rebuild(cell_size)
+
+    def rebuild(self, cell_size):
+        self.cell_size = cell_size
+        width = self.viewport.width + cell_size
+        height = self.viewport.height + cell_size
+        self.surface = pygame.Surface((width, height), pygame.SRCALPHA)
+        for x in range(0, width, cell_size):
+            self.surface.fill(self.color, (x, 0, 1, height))
+        for y in range(0, height, cell_size):
+            self.surface.fill(self.color, (0, y, width, 1))
+        self.surface = self.surface.convert_alpha()
+
+    def draw(self, surface, view_rect):
+        offset_x = view_rect.x % self.cell_size
+        offset_y = view_rect.y % self.cell_size
+        surface.blit(self.surface, self.viewport.topleft,
+                     (offset_x, offset_y, self.viewport.width, self.viewport.height))
+
+grid_overlay = GridOverlay(GRID_SIZE, WORLD_VIEW)
+
+# Retained HUD: the HUD strip is composed into one cached surface that is only
+# redrawn when its state changes, and clicks resolve through a coarse cell lookup
+HIT_CELL = 10
+
+class HudWidget:
+    def __init__(self, kind, key, rect, label=None):
+        self.kind = kind  # 'tile', 'theme', 'character' or 'button'
+        self.key = key
+        self.rect = rect
+        self.label = label
+
+class Hud:
+    def __init__(self, rect, widgets):
+        self.rect = rect
+        self.widgets = widgets
+        self.surface = pygame.Surface(rect.size)
+        self.state = None
+        self.hit_cells = {}
+        for widget in widgets:
+            for cell_y in range(widget.rect.top // HIT_CELL, (widget.rect.bottom - 1) // HIT_CELL + 1):
+                for cell_x in range(widget.rect.left // HIT_CELL, (widget.rect.right - 1) // HIT_CELL + 1):
+                    self.hit_cells.setdefault((cell_x, cell_y), []).append(widget)
+
+    def widgets_at(self, pos):
+        candidates = self.hit_cells.get((pos[0] // HIT_CELL, pos[1] // HIT_CELL), ())
+        return [widget for widget in candidates if widget.rect.collidepoint(pos)]
+
+    def draw(self, surface, state):
+        redrawn = state != self.state
+        if redrawn:
+            self.state = state
+            self.compose(state)
+        surface.blit(self.surface, self.rect)
+        return redrawn
+
+    def compose(self, state):
+        playtest, selected, theme, character, score, coins, p_meter, blocked_at = state
+        hud = self.surface
+        hud.fill(DARK_GRAY)
+        top = self.rect.top
+
+        for widget in self.widgets:
+            rect = widget.rect.move(-self.rect.left, -top)
+            if widget.kind == 'tile':
+                hud.blit(atlas.get('icon', widget.key, ICON_SIZE), rect.topleft)
+                if widget.key == selected:
+                    pygame.draw.rect(hud, GREEN, rect, 3)
+                else:
+                    pygame.draw.rect(hud, BLACK, rect, 1)
+            else:
+                pygame.draw.rect(hud, BLACK, rect, 2)
+                text = text_cache.render(widget.label, BLACK)
+                hud.blit(text, text.get_rect(center=rect.center))
+                if (widget.kind == 'theme' and widget.key == theme) or \
+                        (widget.kind == 'character' and widget.key == character):
+                    pygame.draw.rect(hud, GREEN, rect, 2)
+
+        if playtest:
+            score_text = text_cache.render(f"Score: {score} | Coins: {coins}", YELLOW)
+            hud.blit(score_text, (WINDOW_WIDTH - 300, 10))
+            
+            p_meter_bg = pygame.Rect(10, 40, 150, 20)
+            pygame.draw.rect(hud, BLACK, p_meter_bg)
+            if p_meter > 0:
+                p_meter_fill = pygame.Rect(10, 40, p_meter * 25, 20)
+                pygame.draw.rect(hud, RED if p_meter >= 6 else YELLOW, p_meter_fill)
+            p_meter_text = text_cache.render("P-Meter", WHITE)
+            hud.blit(p_meter_text, (p_meter_bg.centerx - p_meter_text.get_width() // 2, p_meter_bg.y))
+            
+            help_text = text_cache.render(
+                "Controls: Arrows to move, Space/Up to jump, Shift to run, ESC to exit", WHITE)
+        elif blocked_at is not None:
+            help_text = text_cache.render(
+                f"Goal unreachable: the player can't get past x={blocked_at}", RED)
+        else:
+            help_text = text_cache.render(
+                "Edit Mode - Place: Left Click | Remove: Right Click | Undo: Ctrl+Z | Redo: Ctrl+Y", WHITE)
+        hud.blit(help_text, (WINDOW_WIDTH // 2 - help_text.get_width() // 2, 70))
+
+hud = Hud(HUD_RECT,
+          [HudWidget('tile', tile_type, rect) for tile_type, rect in button_positions.items()] +
+          [HudWidget('theme', theme_name, rect, theme_name) for theme_name, rect in theme_buttons.items()] +
+          [HudWidget('character', name, rect, name) for name, rect in character_buttons.items()] +
+          [HudWidget('button', key, rect, button_labels[key]) for key, rect in buttons.items()])
+
+def hud_state():
+    if playtest_mode:
+        return (True, selected_tile_type, current_theme, player.character,
+                player.score, player.coins_collected, player.p_meter, None)
+    return (False, selected_tile_type, current_theme, player.character, None, None, None,
+            None if reachability.goal_reachable else reachability.frontier)
 
 selected_tile_type = 'ground'  # Default selected tile type
 playtest_mode = False  # Flag to indicate playtest mode
@@ -838,7 +2780,7 @@ def main_menu():
                 if start_button.collidepoint(mouse_pos):
                     menu_running = False
                 elif load_button.collidepoint(mouse_pos):
-                    load_level()
+                    load_level(background=True)
                     menu_running = False
                 elif quit_button.collidepoint(mouse_pos):
                     pygame.quit()
@@ -885,96 +2827,21 @@ class AddAction(Action):
         self.tile_type = tile_type
 
     def undo(self):
-        for sprite in all_sprites:
-            if sprite.rect.topleft == self.pos and sprite != player:
-                sprite.kill()
-                if isinstance(sprite, Tile):
-                    tiles_group.remove(sprite)
-                    platforms_group.remove(sprite)
-                elif isinstance(sprite, Enemy):
-                    enemies_group.remove(sprite)
-                elif isinstance(sprite, Coin):
-                    coins_group.remove(sprite)
-                elif isinstance(sprite, PowerUp):
-                    powerups_group.remove(sprite)
+        remove_entity_at(self.pos)
 
     def redo(self):
-        if self.tile_type in ['ground', 'brick', 'question', 'pipe', 'water', 'platform']:
-            tile = Tile(self.pos, self.tile_type)
-            if self.tile_type == 'platform':
-                platforms_group.add(tile)
-            else:
-                tiles_group.add(tile)
-            all_sprites.add(tile)
-        elif self.tile_type == 'enemy':
-            enemy = Enemy(self.pos)
-            enemies_group.add(enemy)
-            all_sprites.add(enemy)
-        elif self.tile_type == 'coin':
-            coin = Coin(self.pos)
-            coins_group.add(coin)
-            all_sprites.add(coin)
-        elif self.tile_type == 'powerup':
-            powerup = PowerUp(self.pos)
-            powerups_group.add(powerup)
-            all_sprites.add(powerup)
+        place_entity(self.pos, self.tile_type)
 
 class RemoveAction(Action):
-    def __init__(self, sprite):
-        self.sprite = sprite
-        self.pos = sprite.rect.topleft
-        
-        if hasattr(sprite, 'tile_type'):
-            self.tile_type = sprite.tile_type 
-        elif isinstance(sprite, Enemy):
-            self.tile_type = 'enemy'
-            if hasattr(sprite, 'enemy_type'):
-                self.enemy_type = sprite.enemy_type
-        elif isinstance(sprite, Coin):
-            self.tile_type = 'coin'
-        elif isinstance(sprite, PowerUp):
-            self.tile_type = 'powerup'
-            if hasattr(sprite, 'powerup_type'):
-                self.powerup_type = sprite.powerup_type
+    def __init__(self, pos, record):
+        self.pos = pos
+        self.tile_type, _, _, self.variant, _ = record
 
     def undo(self):
-        if hasattr(self, 'tile_type'):
-            if self.tile_type in ['ground', 'brick', 'question', 'pipe', 'water', 'platform']:
-                tile = Tile(self.pos, self.tile_type)
-                if self.tile_type == 'platform':
-                    platforms_group.add(tile)
-                else:
-                    tiles_group.add(tile)
-                all_sprites.add(tile)
-            elif self.tile_type == 'enemy':
-                enemy_type = getattr(self, 'enemy_type', 'goomba')
-                enemy = Enemy(self.pos, enemy_type)
-                enemies_group.add(enemy)
-                all_sprites.add(enemy)
-            elif self.tile_type == 'coin':
-                coin = Coin(self.pos)
-                coins_group.add(coin)
-                all_sprites.add(coin)
-            elif self.tile_type == 'powerup':
-                powerup_type = getattr(self, 'powerup_type', 'mushroom')
-                powerup = PowerUp(self.pos, powerup_type)
-                powerups_group.add(powerup)
-                all_sprites.add(powerup)
+        place_entity(self.pos, self.tile_type, self.variant)
 
     def redo(self):
-        for sprite in all_sprites:
-            if sprite.rect.topleft == self.pos and sprite != player:
-                sprite.kill()
-                if isinstance(sprite, Tile):
-                    tiles_group.remove(sprite)
-                    platforms_group.remove(sprite)
-                elif isinstance(sprite, Enemy):
-                    enemies_group.remove(sprite)
-                elif isinstance(sprite, Coin):
-                    coins_group.remove(sprite)
-                elif isinstance(sprite, PowerUp):
-                    powerups_group.remove(sprite)
-                break
+        remove_entity_at(self.pos)
 
 # Settings Menu Function
 def open_settings():
@@ -1063,7 +2930,8 @@ def open_settings():
                 RUN_SPEED_MAX = 3 + int((rel_x / run_slider.width) * 7)
 
         if selected_grid_size != GRID_SIZE:
-            update_grid_size(selected_grid_size)
+            if not update_grid_size(selected_grid_size):
+                selected_grid_size = GRID_SIZE
 
         jump_pos = int(((abs(JUMP_STRENGTH) - 8) / 8) * jump_slider.width)
         pygame.draw.rect(window, GREEN, (jump_slider.x + jump_pos - 5, jump_slider.y, 10, 20))
@@ -1073,230 +2941,392 @@ def open_settings():
 
         pygame.display.update()
         game_clock.tick(60)
+    reachability.reset(GRID_SIZE)  # Jump and run speed change what can be reached
 
 def update_grid_size(new_size):
+    # Returns False, changing nothing, if tiles would end up sharing a cell
     global GRID_SIZE
+    level_chunks.load_all()
+    records = tile_map.records()
+    cells = {(x // new_size, y // new_size) for _, x, y, _, _ in records}
+    if len(cells) < len(records):
+        print(f"Grid size {new_size} would merge {len(records) - len(cells)} tiles into "
+              f"cells already taken; keeping grid size {GRID_SIZE}.")
+        return False
     GRID_SIZE = new_size
-    for sprite in all_sprites:
-        if sprite != player:
-            sprite.rect.topleft = snap_to_grid(sprite.rect.topleft, GRID_SIZE)
+    for sprite in world.entities:
+        sprite.rect.topleft = snap_to_grid(sprite.rect.topleft, GRID_SIZE)
+    tile_map.rebuild(records, GRID_SIZE)
+    cell_index.rebuild(world.entities, GRID_SIZE)
+    static_layer.invalidate()
+    sprite_layer.rebuild(world.of('sprite'))
+    world.rebuild()
+    level_chunks.rebuild(world.entities, GRID_SIZE)
+    level_bounds.size = (WINDOW_WIDTH, WINDOW_HEIGHT)
+    if tile_map.count:
+        level_bounds.union_ip(tile_map.bounds())
+    for sprite in world.entities:
+        level_bounds.union_ip(sprite.rect)
+    grid_overlay.rebuild(GRID_SIZE)
+    reachability.reset(GRID_SIZE)
+    dirty.mark_all()
+    return True
+
+# Simulation, separate from drawing so it can also run headless
+def simulate_tick():
+    # Only what is on or near the screen is live and simulated
+    level_chunks.update(camera.active_rect())
+    nearby = sprite_layer.query(camera.active_rect())
+    slots = world.slots(nearby)
+    movers = slots[world.hazard[slots]]
+    if playtest_mode:
+        near_player = player.rect.inflate(GRID_SIZE * 4, GRID_SIZE * 4)
+        player.update(tile_map, tile_map.rects_in(near_player, 'platform'))
+        despawns = world.despawns
+        contact_system(player, movers)
+        if world.despawns != despawns:
+            slots = world.slots(nearby)
+        despawns = world.despawns
+        pickup_system(player, slots[world.pickup[slots]])
+        player.tick_invincibility()
+        if world.despawns != despawns:
+            slots = world.slots(nearby)
+        movers = slots[world.walker[slots] & (world.hazard[slots] | world.pickup[slots])]
+    for sprite in step_walkers(movers, tile_map):
+        sprite_layer.move(sprite)
+        cell_index.move(sprite)
+        level_chunks.track(sprite)
+    if playtest_mode:
+        camera.follow(player.rect, level_bounds)
+    anim_clock.tick()  # Coins have no update of their own; their spin runs off the clock
+    return world.at(slots[world.hazard[slots]])
+
+SIM_TICK_MS = 1000 / FPS
+MAX_TICKS_PER_FRAME = 5
+
+def simulation_digest():
+    # Fingerprint of the simulated state. Runs with the same level, seed and
+    # inputs produce the same digest; floats go in via repr, so exactly
+    state = [player.rect.topleft, tuple(player.velocity), player.state, player.score,
+             player.coins_collected, player.lives, player.p_meter]
+    for kind in ('enemy', 'powerup'):
+        state.extend((sprite.rect.topleft, tuple(sprite.velocity)) for sprite in world.of('walker')
+                     if sprite.kind == kind)
+    state.extend(coin.rect.topleft for coin in world.of('pickup') if coin.kind == 'coin')
+    return hashlib.sha256(repr(state).encode()).hexdigest()
+
+class InputState:
+    # Stand-in for pygame.key.get_pressed(): the keys listed are held down
+    def __init__(self, pressed=()):
+        self.pressed = set(pressed)
+
+    def __getitem__(self, key):
+        return key in self.pressed
+
+def step(n=1, keys=None):
+    # Advance the playtest by up to n ticks without drawing or frame limiting.
+    # Stops early when the playtest ends or the level is completed; returns the
+    # number of ticks run
+    if keys is not None:
+        player.controls = lambda: keys
+    for tick in range(n):
+        if not playtest_mode or level_completed():
+            return tick
+        simulate_tick()
+    return n
+
+def run_headless(args):
+    # python MFB1.0.py --headless [level file] [ticks]: hold right and run
+    filename = args[0] if args else None
+    ticks = int(args[1]) if len(args) > 1 else 3600
+    load_level(filename)
+    start_playtest()
+    started = pygame.time.get_ticks()
+    ran = step(ticks, InputState([pygame.K_RIGHT, pygame.K_LSHIFT]))
+    seconds = max(pygame.time.get_ticks() - started, 1) / 1000
+    print(f"{ran} ticks in {seconds:.2f}s ({ran / seconds:.0f} ticks/s), completed: {level_completed()}, "
+          f"score: {player.score}, coins: {player.coins_collected}, lives: {player.lives}")
+
+# Batch validation: playtest many levels headlessly across all cores
+VALIDATE_SECONDS = 300  # Per level, in simulated time
+VALIDATE_STALL_SECONDS = 10  # Give up once the player has made no progress for this long
+LEVEL_EXTENSIONS = ('.json', '.mfbl')
+
+class ValidatorAgent:
+    # Scripted playtester: run right, jumping at walls, at enemies ahead and
+    # whenever it stops moving
+    def __init__(self):
+        self.jump_ticks = 0
+        self.last_x = None
+        self.stalled = 0
+
+    def __call__(self):
+        keys = [pygame.K_RIGHT, pygame.K_LSHIFT]
+        if player.on_ground:
+            self.stalled = self.stalled + 1 if player.rect.x == self.last_x else 0
+            self.last_x = player.rect.x
+            ahead = player.rect.move(GRID_SIZE // 2, 0)
+            danger = pygame.Rect(player.rect.right, player.rect.top, GRID_SIZE * 2, player.rect.height)
+            slots = world.slots(sprite_layer.query(danger))
+            if (self.stalled > 2 or tile_map.colliders_in(ahead)
+                    or world.overlapping(danger, slots[world.hazard[slots]]).any()):
+                self.jump_ticks = player.max_jump_hold
+        if self.jump_ticks > 0:
+            keys.append(pygame.K_SPACE)
+            self.jump_ticks -= 1
+        return InputState(keys)
+
+def validate_level(filename):
+    # Check the level statically, then playtest it with the scripted agent until
+    # it is completed, the lives run out, the player gets stuck or time is up
+    result = {"file": filename, "reachable": None, "completed": False, "deaths": 0, "coins": 0,
+              "score": 0, "ticks": 0, "error": None}
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            begin_load(filename, read_level_records(filename))
+            while not step_load():
+                pass
+            result["reachable"] = check_reachability()
+            player.lives = 3
+            player.controls = ValidatorAgent()
+            ticks = 0
+            coins = score = 0  # Over every life, not just the last
+            while ticks < VALIDATE_SECONDS * FPS and player.lives > 0:
+                start_playtest()
+                best_x = player.rect.x
+                progress_tick = ticks
+                while playtest_mode and ticks < VALIDATE_SECONDS * FPS:
+                    simulate_tick()
+                    ticks += 1
+                    if level_completed():
+                        break
+                    if player.rect.x > best_x:
+                        best_x, progress_tick = player.rect.x, ticks
+                    elif ticks - progress_tick >= VALIDATE_STALL_SECONDS * FPS:
+                        break
+                coins += player.coins_collected
+                score += player.score
+                if playtest_mode:
+                    break  # Completed, stuck or out of time; otherwise the player died
+                result["deaths"] += 1
+            result.update(completed=playtest_mode and level_completed(), ticks=ticks,
+                          coins=coins, score=score)
+            if playtest_mode:
+                playtest_reset()  # The next level validated starts from the editor
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    return result
+
+def level_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                if name.endswith(LEVEL_EXTENSIONS)))
+        else:
+            files.append(path)
+    return files
+
+def run_batch(args):
+    # python MFB1.0.py --batch report.json <level files or folders>
+    if len(args) < 2:
+        print("Usage: MFB1.0.py --batch report.json <level files or folders>")
+        return
+    report_file, files = args[0], level_files(args[1:])
+    workers = min(os.cpu_count() or 1, max(len(files), 1))
+    started = time.perf_counter()
+    # Spawned workers import this file as a module, which makes them headless
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        results = list(pool.map(validate_level, files, chunksize=max(1, len(files) // (workers * 8))))
+    seconds = time.perf_counter() - started
+    summary = {"levels": len(results),
+               "completed": sum(result["completed"] for result in results),
+               "errors": sum(result["error"] is not None for result in results),
+               "workers": workers,
+               "seconds": round(seconds, 2)}
+    with open(report_file, 'w') as f:
+        json.dump({"summary": summary, "levels": results}, f, indent=1)
+    print(f"{summary['completed']}/{summary['levels']} levels completed, {summary['errors']} errors, "
+          f"{seconds:.1f}s on {workers} workers. Report written to {report_file}.")
 
 # Define settings panel rectangle
 settings_panel_rect = pygame.Rect(WINDOW_WIDTH//2 - 200, WINDOW_HEIGHT//2 - 150, 400, 300)
 
-# Call the main menu first
-main_menu()
-
-# Main loop
-running = True
-while running:
-    for event in pygame.event.get():
-        if event.type == pygame.QUIT:
-            running = False
-
-        elif event.type == pygame.KEYDOWN:
-            if event.key == pygame.K_SPACE and playtest_mode:
-                player.jump()
-            elif event.key == pygame.K_z and pygame.key.get_mods() & pygame.KMOD_CTRL:
-                if undo_stack:
-                    action = undo_stack.pop()
-                    redo_stack.append(action)
-                    action.undo()
-            elif event.key == pygame.K_y and pygame.key.get_mods() & pygame.KMOD_CTRL:
-                if redo_stack:
-                    action = redo_stack.pop()
-                    undo_stack.append(action)
-                    action.redo()
-            elif event.key == pygame.K_ESCAPE and playtest_mode:
-                playtest_reset()
+if __name__ == "__main__":
+    if "--batch" in sys.argv:
+        run_batch([arg for arg in sys.argv[1:] if arg not in ("--batch", "--headless")])
+        sys.exit()
+    if HEADLESS:
+        run_headless([arg for arg in sys.argv[1:] if arg != "--headless"])
+        level_io.finish()
+        sys.exit()
+
+    # Call the main menu first
+    main_menu()
+
+    # Main loop
+    running = True
+    last_playtest_mode = None
+    last_coin_frame = None
+    last_camera_pos = None
+    last_fps = None
+    sim_accumulator = SIM_TICK_MS
+    active_enemies = []
+    while running:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                running = False
 
-        elif event.type == pygame.MOUSEBUTTONDOWN:
-            mouse_pos = pygame.mouse.get_pos()
+            elif event.type == LEVEL_IO_DONE:
+                finish_level_io(event)
 
-            if not playtest_mode:
-                for tile_type, rect in button_positions.items():
-                    if rect.collidepoint(mouse_pos):
-                        selected_tile_type = tile_type
-                        break
+            elif event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_SPACE and playtest_mode:
+                    player.jump()
+                elif event.key == pygame.K_z and pygame.key.get_mods() & pygame.KMOD_CTRL:
+                    if undo_stack and pending_load is None:
+                        action = undo_stack.pop()
+                        redo_stack.append(action)
+                        action.undo()
+                elif event.key == pygame.K_y and pygame.key.get_mods() & pygame.KMOD_CTRL:
+                    if redo_stack and pending_load is None:
+                        action = redo_stack.pop()
+                        undo_stack.append(action)
+                        action.redo()
+                elif event.key == pygame.K_ESCAPE and playtest_mode:
+                    playtest_reset()
 
-                for theme_name, rect in theme_buttons.items():
-                    if rect.collidepoint(mouse_pos):
-                        set_theme(theme_name)
-                        break
-                        
-                for character_name, rect in character_buttons.items():
-                    if rect.collidepoint(mouse_pos):
-                        player.character = character_name
-                        break
+            elif event.type == pygame.MOUSEBUTTONDOWN:
+                mouse_pos = pygame.mouse.get_pos()
 
-                if buttons["save"].collidepoint(mouse_pos):
-                    save_level()
-                elif buttons["load"].collidepoint(mouse_pos):
-                    load_level()
-                elif buttons["load_construct"].collidepoint(mouse_pos):
-                    load_construct_level(mario_fan_builder_level_data, theme_name='Mario Fan Builder Default')
-                elif buttons["playtest"].collidepoint(mouse_pos):
-                    playtest_mode = True
-                    player.rect.center = (400, WINDOW_HEIGHT - GRID_SIZE)
-                    player.velocity = pygame.Vector2(0, 0)
-                    player.coins_collected = 0
-                    player.score = 0
-                    print("Playtest mode started. Use arrow keys to move, Space to jump, Shift to run.")
-                elif buttons["settings"].collidepoint(mouse_pos):
-                    open_settings()
-                elif buttons["quit"].collidepoint(mouse_pos):
-                    pygame.quit()
-                    sys.exit()
-                else:
-                    if mouse_pos[1] < WINDOW_HEIGHT:
-                        grid_pos = snap_to_grid(mouse_pos, GRID_SIZE)
-                        if event.button == 1:  # Left click to add
-                            action = AddAction(grid_pos, selected_tile_type)
-                            undo_stack.append(action)
-                            redo_stack.clear()
-
-                            for sprite in all_sprites:
-                                if sprite.rect.topleft == grid_pos and sprite != player:
-                                    remove_action = RemoveAction(sprite)
-                                    undo_stack.append(remove_action)
-                                    sprite.kill()
-                                    
-                            if selected_tile_type in ['ground', 'brick', 'question', 'pipe', 'water']:
-                                tile = Tile(grid_pos, selected_tile_type)
-                                tiles_group.add(tile)
-                                all_sprites.add(tile)
-                            elif selected_tile_type == 'platform':
-                                platform = Tile(grid_pos, 'platform')
-                                platforms_group.add(platform)
-                                all_sprites.add(platform)
-                            elif selected_tile_type == 'enemy':
-                                enemy = Enemy(grid_pos, 'goomba')
-                                enemies_group.add(enemy)
-                                all_sprites.add(enemy)
-                            elif selected_tile_type == 'coin':
-                                coin = Coin(grid_pos)
-                                coins_group.add(coin)
-                                all_sprites.add(coin)
-                            elif selected_tile_type == 'powerup':
-                                powerup = PowerUp(grid_pos, 'mushroom')
-                                powerups_group.add(powerup)
-                                all_sprites.add(powerup)
-                        elif event.button == 3:  # Right click to remove
-                            for sprite in all_sprites:
-                                if sprite.rect.collidepoint(mouse_pos) and sprite != player:
-                                    action = RemoveAction(sprite)
-                                    undo_stack.append(action)
+                if not playtest_mode:
+                    hits = hud.widgets_at(mouse_pos)
+                    for widget in hits:
+                        if widget.kind == 'tile':
+                            selected_tile_type = widget.key
+                        elif widget.kind == 'theme':
+                            set_theme(widget.key)
+                        elif widget.kind == 'character':
+                            player.character = widget.key
+                        elif widget.key == "save":
+                            save_level_incremental(background=True)
+                        elif widget.key == "load":
+                            load_level(background=True)
+                        elif widget.key == "load_construct":
+                            load_construct_level(mario_fan_builder_level_data, theme_name='Mario Fan Builder Default')
+                        elif widget.key == "playtest":
+                            start_playtest()
+                        elif widget.key == "settings":
+                            open_settings()
+                            dirty.mark_all()
+                        elif widget.key == "quit":
+                            level_io.finish()
+                            pygame.quit()
+                            sys.exit()
+                    if not hits and pending_load is None:
+                        if mouse_pos[1] < WINDOW_HEIGHT:
+                            grid_pos = snap_to_grid(camera.to_world(mouse_pos), GRID_SIZE)
+                            if event.button == 1:  # Left click to add
+                                redo_stack.clear()
+                                existing = remove_entity_at(grid_pos)
+                                if existing is not None:
+                                    undo_stack.append(RemoveAction(grid_pos, existing))
+                                undo_stack.append(AddAction(grid_pos, selected_tile_type))
+                                place_entity(grid_pos, selected_tile_type)
+                            elif event.button == 3:  # Right click to remove
+                                removed = remove_entity_at(grid_pos)
+                                if removed is not None:
+                                    undo_stack.append(RemoveAction(grid_pos, removed))
                                     redo_stack.clear()
-                                    sprite.kill()
-                                    break
 
-    if playtest_mode:
-        solid_tiles = pygame.sprite.Group([tile for tile in tiles_group if getattr(tile, 'is_solid', False)])
-        player.update(solid_tiles, enemies_group, coins_group, powerups_group, platforms_group)
-        enemies_group.update(solid_tiles)
-        coins_group.update()
-        powerups_group.update(solid_tiles)
-    else:
-        solid_tiles = pygame.sprite.Group([tile for tile in tiles_group if getattr(tile, 'is_solid', False)])
-        enemies_group.update(solid_tiles)
-        coins_group.update()
+        if pending_load is not None:
+            step_load()
 
-    window.fill(themes[current_theme]['background'])
+        # Autosave edits into the journal of the file being worked on
+        if (not playtest_mode and level_file is not None and pending_load is None
+                and pygame.time.get_ticks() - last_save_ticks >= AUTOSAVE_SECONDS * 1000):
+            if level_chunks.dirty or level_chunks.dirty_all or theme_changed:
+                save_level_incremental(level_file, background=True)
+            else:
+                last_save_ticks = pygame.time.get_ticks()
+
+        # Re-check that the goal can still be reached after edits
+        if (not playtest_mode and pending_load is None
+                and reachability.key != (level_chunks.edits, player.character)
+                and pygame.time.get_ticks() - reachability.checked_ticks >= REACH_CHECK_MS):
+            check_reachability()
+
+        if not playtest_mode:
+            keys = pygame.key.get_pressed()
+            pan_speed = CAMERA_PAN_SPEED * (3 if keys[pygame.K_LSHIFT] or keys[pygame.K_RSHIFT] else 1)
+            camera.pan((keys[pygame.K_RIGHT] - keys[pygame.K_LEFT]) * pan_speed,
+                       (keys[pygame.K_DOWN] - keys[pygame.K_UP]) * pan_speed)
+
+        # Fixed timestep: the world always advances in whole SIM_TICK_MS ticks,
+        # however long the last frame took
+        if pending_load is not None:
+            # Nothing streams in or moves until the journal has been replayed
+            sim_accumulator = 0
+            active_enemies = []
+        sim_ticks = 0
+        while sim_accumulator >= SIM_TICK_MS and sim_ticks < MAX_TICKS_PER_FRAME:
+            active_enemies = simulate_tick()
+            sim_accumulator -= SIM_TICK_MS
+            sim_ticks += 1
+        if sim_ticks == MAX_TICKS_PER_FRAME:
+            sim_accumulator = 0  # Too far behind to catch up: slow down instead
+
+        visible = [sprite for sprite in sprite_layer.query(camera.rect)
+                   if sprite.alive() and camera.rect.colliderect(sprite.rect)]
+
+        # Work out which screen regions changed this frame
+        if playtest_mode or playtest_mode != last_playtest_mode or camera.rect.topleft != last_camera_pos:
+            dirty.mark_all()
+        else:
+            dirty.track(active_enemies)
+            if anim_clock.frame('coin') != last_coin_frame:
+                for sprite in visible:
+                    if world.animated[sprite.slot]:
+                        dirty.mark(sprite.rect)
+        last_playtest_mode = playtest_mode
+        last_camera_pos = camera.rect.topleft
+        last_coin_frame = anim_clock.frame('coin')
 
-    for x in range(0, WINDOW_WIDTH, GRID_SIZE):
-        pygame.draw.line(window, GRAY, (x, 0), (x, WINDOW_HEIGHT))
-    for y in range(0, WINDOW_HEIGHT, GRID_SIZE):
-        pygame.draw.line(window, GRAY, (0, y), (WINDOW_WIDTH, y))
+        window.fill(themes[current_theme]['background'])
 
-    all_sprites.draw(window)
+        grid_overlay.draw(window, camera.rect)
 
-    pygame.draw.rect(window, DARK_GRAY, HUD_RECT)
+        static_layer.draw(window, camera.rect)
+        window.blit(player.image, camera.to_screen(player.rect))
+        window.blits([(sprite.image, camera.to_screen(sprite.rect)) for sprite in visible], False)
 
-    for tile_type, rect in button_positions.items():
-        window.blit(tile_icons[tile_type], rect.topleft)
-        if tile_type == selected_tile_type:
-            pygame.draw.rect(window, GREEN, rect, 3)
-        else:
-            pygame.draw.rect(window, BLACK, rect, 1)
-
-    for theme_name, rect in theme_buttons.items():
-        pygame.draw.rect(window, BLACK, rect, 2)
-        theme_text = FONT.render(theme_name, True, BLACK)
-        text_rect = theme_text.get_rect(center=rect.center)
-        window.blit(theme_text, text_rect)
-        if theme_name == current_theme:
-            pygame.draw.rect(window, GREEN, rect, 2)
-            
-    for character_name, rect in character_buttons.items():
-        pygame.draw.rect(window, BLACK, rect, 2)
-        char_text = FONT.render(character_name, True, BLACK)
-        text_rect = char_text.get_rect(center=rect.center)
-        window.blit(char_text, text_rect)
-        if character_name == player.character:
-            pygame.draw.rect(window, GREEN, rect, 2)
-
-    for key, rect in buttons.items():
-        pygame.draw.rect(window, BLACK, rect, 2)
-        if key == "save":
-            text = "Save"
-        elif key == "load":
-            text = "Load"
-        elif key == "load_construct":
-            text = "Load Template"
-        elif key == "playtest":
-            text = "Playtest"
-        elif key == "settings":
-            text = "Settings"
-        elif key == "quit":
-            text = "Quit"
-        button_text = FONT.render(text, True, BLACK)
-        text_rect = button_text.get_rect(center=rect.center)
-        window.blit(button_text, text_rect)
-
-    fps = int(game_clock.get_fps())
-    fps_text = FONT.render(f"FPS: {fps}", True, YELLOW)
-    window.blit(fps_text, (WINDOW_WIDTH - 100, 10))
+        if hud.draw(window, hud_state()):
+            dirty.mark_screen(HUD_RECT)
 
-    if playtest_mode:
-        player_state = player.state.capitalize()
-        status_text = FONT.render(
-            f"Character: {player.character.capitalize()} | State: {player_state} | Lives: {player.lives}",
-            True, YELLOW
-        )
-        window.blit(status_text, (10, 10))
-        
-        score_text = FONT.render(f"Score: {player.score} | Coins: {player.coins_collected}", True, YELLOW)
-        window.blit(score_text, (WINDOW_WIDTH - 300, WINDOW_HEIGHT + 10))
-        
-        p_meter_bg = pygame.Rect(10, WINDOW_HEIGHT + 40, 150, 20)
-        pygame.draw.rect(window, BLACK, p_meter_bg)
-        if player.p_meter > 0:
-            p_meter_fill = pygame.Rect(10, WINDOW_HEIGHT + 40, player.p_meter * 25, 20)
-            pygame.draw.rect(window, RED if player.p_meter >= 6 else YELLOW, p_meter_fill)
-        p_meter_text = FONT.render("P-Meter", True, WHITE)
-        window.blit(p_meter_text, (p_meter_bg.centerx - p_meter_text.get_width() // 2, p_meter_bg.y))
-        
-        controls_text = FONT.render(
-            "Controls: Arrows to move, Space/Up to jump, Shift to run, ESC to exit",
-            True, WHITE
-        )
-        window.blit(controls_text, (WINDOW_WIDTH // 2 - controls_text.get_width() // 2, WINDOW_HEIGHT + 70))
+        fps = int(game_clock.get_fps())
+        window.blit(text_cache.render(f"FPS: {fps}", YELLOW), (WINDOW_WIDTH - 100, 10))
+        if fps != last_fps:
+            dirty.mark_screen(FPS_RECT)
+            last_fps = fps
+
+        if playtest_mode:
+            player_state = player.state.capitalize()
+            status_text = text_cache.render(
+                f"Character: {player.character.capitalize()} | State: {player_state} | Lives: {player.lives}",
+                YELLOW
+            )
+            window.blit(status_text, (10, 10))
         
-        if player.rect.right >= WINDOW_WIDTH - GRID_SIZE:
-            success_text = pygame.font.Font(None, 36).render("Level Completed!", True, GREEN)
-            window.blit(success_text, (WINDOW_WIDTH // 2 - success_text.get_width() // 2, WINDOW_HEIGHT // 2))
-            pygame.display.update()
-            pygame.time.delay(2000)
-            playtest_reset()
-    else:
-        edit_text = FONT.render(
-            "Edit Mode - Place: Left Click | Remove: Right Click | Undo: Ctrl+Z | Redo: Ctrl+Y", 
-            True, WHITE
-        )
-        window.blit(edit_text, (WINDOW_WIDTH // 2 - edit_text.get_width() // 2, WINDOW_HEIGHT + 70))
+            if level_completed():
+                success_text = pygame.font.Font(None, 36).render("Level Completed!", True, GREEN)
+                window.blit(success_text, (WINDOW_WIDTH // 2 - success_text.get_width() // 2, WINDOW_HEIGHT // 2))
+                pygame.display.update()
+                pygame.time.delay(2000)
+                playtest_reset()
 
-    pygame.display.update()
-    game_clock.tick(FPS)
+        dirty.present()
+        sim_accumulator += game_clock.tick(FPS)
 
-pygame.quit()
-sys.exit()
+    level_io.finish()
+    pygame.quit()
+    sys.exit()
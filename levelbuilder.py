@@ -46,6 +46,7 @@ game_clock = pygame.time.Clock()
 
 player = Player()
 blocks_group = pygame.sprite.Group()
+blocks_by_cell = {}  # grid position -> block placed there
 running = True
 block_size = 50  # Size of the grid
 
@@ -59,14 +60,14 @@ while running:
         elif event.type == pygame.MOUSEBUTTONDOWN:
             grid_pos = snap_to_grid(pygame.mouse.get_pos(), block_size)
             if event.button == 1:  # Left click to add a block
-                if not any(block.rect.topleft == grid_pos for block in blocks_group):
+                if grid_pos not in blocks_by_cell:
                     block = Block(grid_pos)
                     blocks_group.add(block)
+                    blocks_by_cell[grid_pos] = block
             elif event.button == 3:  # Right click to remove a block
-                for block in blocks_group:
-                    if block.rect.collidepoint(pygame.mouse.get_pos()):
-                        block.kill()
-                        break
+                block = blocks_by_cell.pop(grid_pos, None)
+                if block is not None:
+                    block.kill()
 
     keys = pygame.key.get_pressed()
     if keys[pygame.K_LEFT]:
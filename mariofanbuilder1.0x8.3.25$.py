@@ -2,9 +2,11 @@ import pygame
 import json
 import sys
 import os
+import random
 from collections import deque
 from enum import Enum
 import math
+import numpy as np
 
 pygame.init()
 
@@ -13,6 +15,9 @@ WINDOW_WIDTH, WINDOW_HEIGHT = 1200, 800
 HUD_HEIGHT = 120
 GRID_SIZE = 50
 FPS = 60
+SIM_TICK_MS = 1000 / FPS  # The world always advances in steps of this size
+MAX_TICKS_PER_FRAME = 5
+SIM_SEED = 0  # Effects RNG seed, reset when a playtest starts
 
 # Enhanced Color Palette
 WHITE = (255, 255, 255)
@@ -113,121 +118,414 @@ FONT = pygame.font.Font(None, 24)
 FONT_LARGE = pygame.font.Font(None, 36)
 FONT_SMALL = pygame.font.Font(None, 18)
 
-# Particle System for visual effects
-class Particle:
-    def __init__(self, pos, velocity, color, lifetime=30):
-        self.pos = list(pos)
-        self.velocity = velocity
-        self.color = color
-        self.lifetime = lifetime
-        self.initial_lifetime = lifetime
-        
+# Particle System for visual effects: a fixed-capacity pool stored as arrays.
+# Dead particles are swap-removed so the live ones stay packed at the front,
+# all of them move in one vectorized step, and each is drawn by blitting a
+# circle pre-rendered per color and size
+PARTICLE_CAPACITY = 4096
+PARTICLE_GRAVITY = 0.5
+PARTICLE_MAX_SIZE = 5
+
+class ParticlePool:
+    def __init__(self, capacity=PARTICLE_CAPACITY):
+        self.capacity = capacity
+        self.count = 0
+        self.pos = np.zeros((capacity, 2))
+        self.velocity = np.zeros((capacity, 2))
+        self.lifetime = np.zeros(capacity, np.int32)
+        self.initial_lifetime = np.ones(capacity, np.int32)
+        self.color = np.zeros(capacity, np.int32)
+        self.colors = []        # Palette; particles store an index into it
+        self.color_index = {}
+        self.circles = {}       # (color index, radius) -> pre-rendered circle
+
+    def emit(self, pos, velocity, color, lifetime=30):
+        if self.count == self.capacity:
+            return  # Full: drop it rather than grow mid-frame
+        if color not in self.color_index:
+            self.color_index[color] = len(self.colors)
+            self.colors.append(color)
+        i = self.count
+        self.pos[i] = pos
+        self.velocity[i] = velocity
+        self.lifetime[i] = lifetime
+        self.initial_lifetime[i] = lifetime
+        self.color[i] = self.color_index[color]
+        self.count += 1
+
     def update(self):
-        self.pos[0] += self.velocity[0]
-        self.pos[1] += self.velocity[1]
-        self.velocity[1] += 0.5  # Gravity
-        self.lifetime -= 1
-        
+        n = self.count
+        self.pos[:n] += self.velocity[:n]
+        self.velocity[:n, 1] += PARTICLE_GRAVITY
+        self.lifetime[:n] -= 1
+
+        # Swap-remove: live particles from the tail fill the dead slots in front
+        alive = self.lifetime[:n] > 0
+        live = int(alive.sum())
+        holes = np.flatnonzero(~alive[:live])
+        if len(holes):
+            fillers = live + np.flatnonzero(alive[live:])
+            for array in (self.pos, self.velocity, self.lifetime, self.initial_lifetime, self.color):
+                array[holes] = array[fillers]
+        self.count = live
+
+    def circle(self, color, radius):
+        key = (color, radius)
+        if key not in self.circles:
+            surface = pygame.Surface((radius * 2, radius * 2), pygame.SRCALPHA)
+            pygame.draw.circle(surface, self.colors[color], (radius, radius), radius)
+            self.circles[key] = surface
+        return self.circles[key]
+
     def draw(self, surface):
-        if self.lifetime > 0:
-            alpha = int(255 * (self.lifetime / self.initial_lifetime))
-            size = int(5 * (self.lifetime / self.initial_lifetime))
-            pygame.draw.circle(surface, self.color, (int(self.pos[0]), int(self.pos[1])), size)
+        n = self.count
+        radius = PARTICLE_MAX_SIZE * self.lifetime[:n] // self.initial_lifetime[:n]
+        corner = self.pos[:n].astype(np.int32) - radius[:, None]
+        width, height = surface.get_size()
+        shown = np.flatnonzero((radius > 0) & (corner[:, 0] < width) & (corner[:, 1] < height)
+                               & (corner[:, 0] + 2 * radius > 0) & (corner[:, 1] + 2 * radius > 0))
+        corner = corner[shown]
+        surface.blits([(self.circle(color, size), (x, y)) for color, size, (x, y)
+                       in zip(self.color[shown].tolist(), radius[shown].tolist(), corner.tolist())],
+                      False)
+
+    def clear(self):
+        self.count = 0
+
+particles = ParticlePool()
+effects_rng = random.Random(SIM_SEED)
+
+SOLID_TILE_TYPES = ['ground', 'brick', 'question', 'water', 'pipe']
+
+# Collision map: one slot per grid cell, kept in sync by Tile creation/kill()
+# so collision queries only look at the cells an entity's rect overlaps
+class SolidGrid:
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cols = 0
+        self.rows = 0
+        self.cells = []
+
+    def _grow(self, cols, rows):
+        if cols <= self.cols and rows <= self.rows:
+            return
+        new_cols = max(cols, self.cols * 2, 32) if cols > self.cols else self.cols
+        new_rows = max(rows, self.rows * 2, 16) if rows > self.rows else self.rows
+        cells = [None] * (new_cols * new_rows)
+        for row in range(self.rows):
+            start = row * self.cols
+            cells[row * new_cols:row * new_cols + self.cols] = self.cells[start:start + self.cols]
+        self.cols, self.rows, self.cells = new_cols, new_rows, cells
+
+    def _span(self, rect):
+        size = self.cell_size
+        return (max(rect.left // size, 0), (rect.right - 1) // size,
+                max(rect.top // size, 0), (rect.bottom - 1) // size)
+
+    def add(self, tile):
+        left, right, top, bottom = self._span(tile.rect)
+        if right < left or bottom < top:
+            return
+        self._grow(right + 1, bottom + 1)
+        for row in range(top, bottom + 1):
+            base = row * self.cols
+            for col in range(left, right + 1):
+                self.cells[base + col] = tile
+
+    def remove(self, tile):
+        left, right, top, bottom = self._span(tile.rect)
+        right = min(right, self.cols - 1)
+        bottom = min(bottom, self.rows - 1)
+        for row in range(top, bottom + 1):
+            base = row * self.cols
+            for col in range(left, right + 1):
+                if self.cells[base + col] is tile:
+                    self.cells[base + col] = None
+
+    def clear(self):
+        self.cells = [None] * len(self.cells)
+
+    def rebuild(self, tiles, cell_size=None):
+        if cell_size is not None:
+            self.cell_size = cell_size
+        self.cols, self.rows, self.cells = 0, 0, []
+        for tile in tiles:
+            if tile.tile_type in SOLID_TILE_TYPES:
+                self.add(tile)
+
+    def collide(self, rect):
+        left, right, top, bottom = self._span(rect)
+        right = min(right, self.cols - 1)
+        bottom = min(bottom, self.rows - 1)
+        hits = []
+        for row in range(top, bottom + 1):
+            base = row * self.cols
+            for col in range(left, right + 1):
+                tile = self.cells[base + col]
+                if tile is not None and tile not in hits and rect.colliderect(tile.rect):
+                    hits.append(tile)
+        return hits
+
+# Editor occupancy: grid cell -> the entities placed there, filed by the cell
+# under their centre. Enemies are moved along as they walk into another cell,
+# so clicking where an entity is now finds it
+class CellIndex:
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}  # (col, row) -> {sprite: None}, most recently added last
+
+    def cell_at(self, pos):
+        return pos[0] // self.cell_size, pos[1] // self.cell_size
+
+    def add(self, sprite):
+        sprite.cell = self.cell_at(sprite.rect.center)
+        self.cells.setdefault(sprite.cell, {})[sprite] = None
+
+    def remove(self, sprite):
+        sprites = self.cells.get(getattr(sprite, 'cell', None))
+        if sprites is not None:
+            sprites.pop(sprite, None)
+            if not sprites:
+                del self.cells[sprite.cell]
+
+    def move(self, sprite):
+        if self.cell_at(sprite.rect.center) != sprite.cell:
+            self.remove(sprite)
+            self.add(sprite)
+
+    def get(self, pos):
+        sprites = self.cells.get(self.cell_at(pos))
+        return next(reversed(sprites)) if sprites else None
+
+    def clear(self):
+        self.cells.clear()
+
+    def rebuild(self, sprites, cell_size=None):
+        if cell_size is not None:
+            self.cell_size = cell_size
+        self.cells.clear()
+        for sprite in sprites:
+            if hasattr(sprite, 'cell'):
+                self.add(sprite)
+
+# Animation strip painters: each returns every frame of one animated look
+QUESTION_MIN_SIZE = 0.8  # Question block scale at rest, pulses up from here
+
+def shade(color, amount):
+    # Lighten (or darken with a negative amount), clamped to valid color values
+    return tuple(max(0, min(255, channel + amount)) for channel in color[:3])
+
+def paint_tile_strip(theme_colors, tile_type, size):
+    base_color = theme_colors.get(tile_type, WHITE)
+    
+    if tile_type == 'question':
+        # One frame per pixel size the pulse can reach
+        temp_surface = pygame.Surface((size, size))
+        temp_surface.fill(base_color)
+        pygame.draw.rect(temp_surface, 
+                       shade(base_color, 30),
+                       (5, 5, size - 10, size - 10), 2)
+        # Draw question mark
+        font = pygame.font.Font(None, 36)
+        text = font.render("?", True, BLACK)
+        text_rect = text.get_rect(center=(size // 2, size // 2))
+        temp_surface.blit(text, text_rect)
+        # Frames share the largest pulse size so the block stays centered in its rect
+        smallest = int(size * QUESTION_MIN_SIZE)
+        largest = int(size * (QUESTION_MIN_SIZE + QUESTION_BLOCK_PULSE))
+        frames = []
+        for frame_size in range(smallest, largest + 1):
+            frame = pygame.Surface((largest, largest), pygame.SRCALPHA)
+            offset = (largest - frame_size) // 2
+            frame.blit(pygame.transform.scale(temp_surface, (frame_size, frame_size)), (offset, offset))
+            frames.append(frame)
+        return frames
+        
+    if tile_type == 'water':
+        # One frame per wave offset (-3..3)
+        lighter_blue = shade(base_color, 30)
+        frames = []
+        for wave_offset in range(-3, 4):
+            image = pygame.Surface((size, size))
+            image.fill(base_color)
+            for i in range(0, size, 10):
+                pygame.draw.line(image, lighter_blue,
+                               (0, i + wave_offset), (size, i + wave_offset), 2)
+            frames.append(image)
+        return frames
+    
+    image = pygame.Surface((size, size))
+    image.fill(base_color)
+    
+    # Enhanced graphics for different tile types
+    if tile_type == 'ground':
+        # Add texture pattern
+        for i in range(0, size, 4):
+            pygame.draw.line(image, shade(base_color, -20), (i, 0), (i, size), 1)
+            pygame.draw.line(image, shade(base_color, -20), (0, i), (size, i), 1)
+                           
+    elif tile_type == 'brick':
+        # Brick pattern
+        brick_color = shade(base_color, -30)
+        for y in range(0, size, 10):
+            for x in range(0, size, 20):
+                offset = 10 if (y // 10) % 2 else 0
+                pygame.draw.rect(image, brick_color,
+                               (x - offset, y, 18, 8), 1)
+                               
+    elif tile_type == 'pipe':
+        # Pipe graphics
+        pygame.draw.rect(image, base_color, (5, 0, size - 10, size))
+        pygame.draw.rect(image, shade(base_color, 20), (0, 0, size, 15))
+        pygame.draw.rect(image, BLACK, (5, 0, size - 10, size), 2)
+        pygame.draw.rect(image, BLACK, (0, 0, size, 15), 2)
+    return [image]
+
+def paint_enemy_strip(theme_colors, enemy_type, size):
+    # Frames indexed by (eye_offset + 2) * 2 + facing_right
+    frames = []
+    for eye_offset in range(-2, 3):
+        for facing_right in (False, True):
+            image = pygame.Surface((size, size))
+            image.fill(theme_colors['enemy'])
+            
+            # Draw enemy features
+            if enemy_type == 'goomba':
+                # Body
+                pygame.draw.ellipse(image, theme_colors['enemy'],
+                                  (5, 10, size - 10, size - 15))
+                # Eyes
+                pygame.draw.circle(image, WHITE, (15, 20 + eye_offset), 5)
+                pygame.draw.circle(image, WHITE, (35, 20 + eye_offset), 5)
+                pygame.draw.circle(image, BLACK, (17 if facing_right else 13, 20 + eye_offset), 3)
+                pygame.draw.circle(image, BLACK, (37 if facing_right else 33, 20 + eye_offset), 3)
+            frames.append(image)
+    return frames
+
+def paint_coin_strip(theme_colors, variant, size):
+    coin_color = theme_colors['coin']
+    original_image = pygame.Surface((size, size), pygame.SRCALPHA)
+    # Draw coin with 3D effect
+    pygame.draw.ellipse(original_image, coin_color,
+                      (10, 10, size - 20, size - 20))
+    pygame.draw.ellipse(original_image, 
+                      (min(255, coin_color[0] + 50), 
+                       min(255, coin_color[1] + 50), 
+                       coin_color[2]),
+                      (15, 15, size - 30, size - 30), 3)
+    # Coin symbol
+    font = pygame.font.Font(None, 24)
+    text = font.render("$", True, BLACK)
+    text_rect = text.get_rect(center=(size // 2, size // 2))
+    original_image.blit(text, text_rect)
+    # One pre-rotated frame per rotation step
+    return [pygame.transform.rotate(original_image, angle)
+            for angle in range(0, 360, COIN_ROTATION_SPEED)]
+
+# Animation strips: all frames of a look are rendered once per
+# (theme, kind, variant, grid size), so animating is an index lookup
+class AnimationStrips:
+    def __init__(self, painters):
+        self.painters = painters
+        self.strips = {}
+
+    def get(self, kind, variant=None, size=None):
+        key = (current_theme, kind, variant, size or GRID_SIZE)
+        strip = self.strips.get(key)
+        if strip is None:
+            strip = self.painters[kind](themes[current_theme], variant, key[3])
+            self.strips[key] = strip
+        return strip
+
+strips = AnimationStrips({
+    'tile': paint_tile_strip,
+    'enemy': paint_enemy_strip,
+    'coin': paint_coin_strip,
+})
+
+# Shared animation clock: coins, question blocks and water all animate in
+# lockstep, so one clock advanced per frame replaces their per-sprite
+# update() calls. The frame index is read when the sprite is drawn.
+def question_track(ticks):
+    pulse = abs(math.sin(ticks * ANIMATION_SPEED)) * QUESTION_BLOCK_PULSE
+    return int(GRID_SIZE * (QUESTION_MIN_SIZE + pulse)) - int(GRID_SIZE * QUESTION_MIN_SIZE)
+
+def water_track(ticks):
+    return int(math.sin(ticks * ANIMATION_SPEED * 2) * 3) + 3
+
+def coin_track(ticks):
+    return ticks % (360 // COIN_ROTATION_SPEED)
+
+class AnimationClock:
+    def __init__(self, tracks):
+        self.tracks = tracks
+        self.ticks = 0
+        self.frames = {}
 
-particles = []
+    def tick(self):
+        self.ticks += 1
+        self.frames.clear()
+
+    def frame(self, kind):
+        index = self.frames.get(kind)
+        if index is None:
+            index = self.frames[kind] = self.tracks[kind](self.ticks)
+        return index
+
+anim_clock = AnimationClock({
+    'question': question_track,
+    'water': water_track,
+    'coin': coin_track,
+})
 
 # Enhanced Tile class with animations
 class Tile(pygame.sprite.Sprite):
     def __init__(self, pos, tile_type):
         super().__init__()
         self.tile_type = tile_type
-        self.image = pygame.Surface((GRID_SIZE, GRID_SIZE))
-        self.rect = self.image.get_rect(topleft=pos)
-        self.animation_time = 0
-        self.pulse = 0
+        self.rect = pygame.Rect(pos, (GRID_SIZE, GRID_SIZE))
         self.update_image()
-        
-    def update(self):
-        self.animation_time += ANIMATION_SPEED
-        if self.tile_type == 'question':
-            self.pulse = abs(math.sin(self.animation_time)) * QUESTION_BLOCK_PULSE
+        # Question blocks are drawn smaller than the cell, centered in it
+        self.rect = self.frames[0].get_rect(center=self.rect.center)
+        if tile_type in SOLID_TILE_TYPES:
+            solid_grid.add(self)
+
+    def kill(self):
+        solid_grid.remove(self)
+        cell_index.remove(self)
+        super().kill()
             
     def update_image(self):
-        theme_colors = themes[current_theme]
-        base_color = theme_colors.get(self.tile_type, WHITE)
-        self.image.fill(base_color)
-        
-        # Enhanced graphics for different tile types
-        if self.tile_type == 'ground':
-            # Add texture pattern
-            for i in range(0, GRID_SIZE, 4):
-                pygame.draw.line(self.image, 
-                               (base_color[0] - 20, base_color[1] - 20, base_color[2] - 20),
-                               (i, 0), (i, GRID_SIZE), 1)
-                pygame.draw.line(self.image, 
-                               (base_color[0] - 20, base_color[1] - 20, base_color[2] - 20),
-                               (0, i), (GRID_SIZE, i), 1)
-                               
-        elif self.tile_type == 'brick':
-            # Brick pattern
-            brick_color = (base_color[0] - 30, base_color[1] - 30, base_color[2] - 30)
-            for y in range(0, GRID_SIZE, 10):
-                for x in range(0, GRID_SIZE, 20):
-                    offset = 10 if (y // 10) % 2 else 0
-                    pygame.draw.rect(self.image, brick_color,
-                                   (x - offset, y, 18, 8), 1)
-                                   
-        elif self.tile_type == 'question':
-            # Animated question mark
-            size = int(GRID_SIZE * (0.8 + self.pulse))
-            temp_surface = pygame.Surface((GRID_SIZE, GRID_SIZE))
-            temp_surface.fill(base_color)
-            pygame.draw.rect(temp_surface, 
-                           (base_color[0] + 30, base_color[1] + 30, base_color[2]),
-                           (5, 5, GRID_SIZE - 10, GRID_SIZE - 10), 2)
-            # Draw question mark
-            font = pygame.font.Font(None, 36)
-            text = font.render("?", True, BLACK)
-            text_rect = text.get_rect(center=(GRID_SIZE // 2, GRID_SIZE // 2))
-            temp_surface.blit(text, text_rect)
-            self.image = pygame.transform.scale(temp_surface, (size, size))
-            self.rect = self.image.get_rect(center=self.rect.center)
-            
-        elif self.tile_type == 'water':
-            # Animated water effect
-            wave_offset = int(math.sin(self.animation_time * 2) * 3)
-            pygame.draw.rect(self.image, base_color, (0, 0, GRID_SIZE, GRID_SIZE))
-            lighter_blue = (base_color[0] + 30, base_color[1] + 30, min(255, base_color[2] + 30))
-            for i in range(0, GRID_SIZE, 10):
-                pygame.draw.line(self.image, lighter_blue,
-                               (0, i + wave_offset), (GRID_SIZE, i + wave_offset), 2)
-                               
-        elif self.tile_type == 'pipe':
-            # Pipe graphics
-            pygame.draw.rect(self.image, base_color, (5, 0, GRID_SIZE - 10, GRID_SIZE))
-            pygame.draw.rect(self.image, (base_color[0] + 20, base_color[1] + 20, base_color[2] + 20),
-                           (0, 0, GRID_SIZE, 15))
-            pygame.draw.rect(self.image, BLACK, (5, 0, GRID_SIZE - 10, GRID_SIZE), 2)
-            pygame.draw.rect(self.image, BLACK, (0, 0, GRID_SIZE, 15), 2)
+        self.frames = strips.get('tile', self.tile_type)
+
+    @property
+    def image(self):
+        # Animated question mark and water come from the shared clock
+        if len(self.frames) == 1:
+            return self.frames[0]
+        return self.frames[anim_clock.frame(self.tile_type)]
 
 # Enhanced Enemy with animations
 class Enemy(pygame.sprite.Sprite):
     def __init__(self, pos, enemy_type='goomba'):
         super().__init__()
         self.enemy_type = enemy_type
-        self.image = pygame.Surface((GRID_SIZE, GRID_SIZE))
-        self.rect = self.image.get_rect(topleft=pos)
+        self.rect = pygame.Rect(pos, (GRID_SIZE, GRID_SIZE))
         self.velocity = pygame.Vector2(2, 0)
         self.animation_time = 0
         self.facing_right = True
         self.update_image()
+
+    def kill(self):
+        cell_index.remove(self)
+        super().kill()
         
-    def update(self, solid_tiles):
+    def update(self, solid_map):
         self.animation_time += ANIMATION_SPEED
         self.rect.x += self.velocity.x
         
         # Check collisions
-        collisions = pygame.sprite.spritecollide(self, solid_tiles, False)
+        collisions = solid_map.collide(self.rect)
         if collisions:
             self.velocity.x *= -1
             self.facing_right = not self.facing_right
@@ -235,64 +533,37 @@ class Enemy(pygame.sprite.Sprite):
             
         # Apply gravity
         self.rect.y += 2
-        floor_collisions = pygame.sprite.spritecollide(self, solid_tiles, False)
+        floor_collisions = solid_map.collide(self.rect)
         if floor_collisions:
             self.rect.bottom = floor_collisions[0].rect.top
+        cell_index.move(self)
             
         self.update_image()
         
     def update_image(self):
-        self.image.fill(themes[current_theme]['enemy'])
-        
-        # Draw enemy features
-        if self.enemy_type == 'goomba':
-            # Body
-            pygame.draw.ellipse(self.image, themes[current_theme]['enemy'],
-                              (5, 10, GRID_SIZE - 10, GRID_SIZE - 15))
-            # Eyes
-            eye_offset = int(math.sin(self.animation_time * 2) * 2)
-            pygame.draw.circle(self.image, WHITE, (15, 20 + eye_offset), 5)
-            pygame.draw.circle(self.image, WHITE, (35, 20 + eye_offset), 5)
-            pygame.draw.circle(self.image, BLACK, (17 if self.facing_right else 13, 20 + eye_offset), 3)
-            pygame.draw.circle(self.image, BLACK, (37 if self.facing_right else 33, 20 + eye_offset), 3)
+        eye_offset = int(math.sin(self.animation_time * 2) * 2)
+        frames = strips.get('enemy', self.enemy_type)
+        self.image = frames[(eye_offset + 2) * 2 + int(self.facing_right)]
 
 # Enhanced Coin with rotation
 class Coin(pygame.sprite.Sprite):
     def __init__(self, pos):
         super().__init__()
-        self.original_image = pygame.Surface((GRID_SIZE, GRID_SIZE), pygame.SRCALPHA)
-        self.image = self.original_image.copy()
-        self.rect = self.image.get_rect(topleft=pos)
-        self.rotation = 0
-        self.bob_offset = 0
-        self.animation_time = 0
-        self.update_image()
-        
-    def update(self):
-        self.animation_time += ANIMATION_SPEED
-        self.rotation += COIN_ROTATION_SPEED
-        self.bob_offset = math.sin(self.animation_time * 2) * 5
-        
-        # Rotate coin
-        self.image = pygame.transform.rotate(self.original_image, self.rotation)
-        self.rect = self.image.get_rect(center=(self.rect.centerx, 
-                                               self.rect.centery + self.bob_offset))
-        
-    def update_image(self):
-        coin_color = themes[current_theme]['coin']
-        # Draw coin with 3D effect
-        pygame.draw.ellipse(self.original_image, coin_color,
-                          (10, 10, GRID_SIZE - 20, GRID_SIZE - 20))
-        pygame.draw.ellipse(self.original_image, 
-                          (min(255, coin_color[0] + 50), 
-                           min(255, coin_color[1] + 50), 
-                           coin_color[2]),
-                          (15, 15, GRID_SIZE - 30, GRID_SIZE - 30), 3)
-        # Coin symbol
-        font = pygame.font.Font(None, 24)
-        text = font.render("$", True, BLACK)
-        text_rect = text.get_rect(center=(GRID_SIZE // 2, GRID_SIZE // 2))
-        self.original_image.blit(text, text_rect)
+        # rect stays on the placed cell; spin and bob are applied in draw_coins()
+        self.rect = pygame.Rect(pos, (GRID_SIZE, GRID_SIZE))
+
+    def kill(self):
+        cell_index.remove(self)
+        super().kill()
+
+def draw_coins(surface):
+    # All coins share the clock's rotation frame and bob offset
+    frames = strips.get('coin')
+    image = frames[anim_clock.frame('coin')]
+    bob_offset = math.sin(anim_clock.ticks * ANIMATION_SPEED * 2) * 5
+    half_width, half_height = image.get_width() // 2, image.get_height() // 2
+    surface.blits([(image, (coin.rect.centerx - half_width, coin.rect.centery - half_height + bob_offset))
+                   for coin in coins_group], False)
 
 # Enhanced Player with smooth animations
 class Player(pygame.sprite.Sprite):
@@ -308,7 +579,7 @@ class Player(pygame.sprite.Sprite):
         self.jump_power = -15
         self.update_image()
         
-    def update(self, solid_tiles, enemies, coins):
+    def update(self, solid_map, enemies, coins):
         self.animation_time += ANIMATION_SPEED
         keys = pygame.key.get_pressed()
         
@@ -329,11 +600,11 @@ class Player(pygame.sprite.Sprite):
         
         # Move and handle collisions
         self.rect.x += self.velocity.x
-        self.handle_collisions(self.velocity.x, 0, solid_tiles)
+        self.handle_collisions(self.velocity.x, 0, solid_map)
         
         self.rect.y += self.velocity.y
         self.on_ground = False
-        self.handle_collisions(0, self.velocity.y, solid_tiles)
+        self.handle_collisions(0, self.velocity.y, solid_map)
         
         # Screen boundaries
         self.rect.x = max(0, min(self.rect.x, WINDOW_WIDTH - self.rect.width))
@@ -347,12 +618,12 @@ class Player(pygame.sprite.Sprite):
         if enemy_hit:
             # Create particles
             for _ in range(20):
-                particles.append(Particle(
+                particles.emit(
                     self.rect.center,
-                    [pygame.time.get_ticks() % 10 - 5, pygame.time.get_ticks() % 10 - 10],
+                    (effects_rng.randrange(10) - 5, effects_rng.randrange(10) - 10),
                     RED,
                     30
-                ))
+                )
             playtest_reset()
             
         # Coin collection with particle effect
@@ -361,17 +632,17 @@ class Player(pygame.sprite.Sprite):
             self.coins_collected += 1
             # Create sparkle particles
             for _ in range(10):
-                particles.append(Particle(
+                particles.emit(
                     coin.rect.center,
-                    [pygame.time.get_ticks() % 6 - 3, pygame.time.get_ticks() % 6 - 6],
+                    (effects_rng.randrange(6) - 3, effects_rng.randrange(6) - 6),
                     YELLOW,
                     20
-                ))
+                )
                 
         self.update_image()
         
-    def handle_collisions(self, vel_x, vel_y, solid_tiles):
-        collisions = pygame.sprite.spritecollide(self, solid_tiles, False)
+    def handle_collisions(self, vel_x, vel_y, solid_map):
+        collisions = solid_map.collide(self.rect)
         for tile in collisions:
             if vel_x > 0:
                 self.rect.right = tile.rect.left
@@ -389,12 +660,12 @@ class Player(pygame.sprite.Sprite):
                 # Hit question block effect
                 if hasattr(tile, 'tile_type') and tile.tile_type == 'question':
                     for _ in range(5):
-                        particles.append(Particle(
+                        particles.emit(
                             tile.rect.center,
-                            [pygame.time.get_ticks() % 4 - 2, -5],
+                            (effects_rng.randrange(4) - 2, -5),
                             YELLOW,
                             25
-                        ))
+                        )
                         
     def jump(self):
         if self.on_ground:
@@ -402,12 +673,12 @@ class Player(pygame.sprite.Sprite):
             self.on_ground = False
             # Jump particles
             for _ in range(5):
-                particles.append(Particle(
+                particles.emit(
                     (self.rect.centerx, self.rect.bottom),
-                    [pygame.time.get_ticks() % 4 - 2, 2],
+                    (effects_rng.randrange(4) - 2, 2),
                     WHITE,
                     15
-                ))
+                )
                 
     def update_image(self):
         # Simple Mario-like character
@@ -428,37 +699,99 @@ class Player(pygame.sprite.Sprite):
         pygame.draw.rect(self.image, BLUE, 
                         (20 - leg_offset, 35, 10, 10))
 
-# Background renderer with gradient
-def draw_background(surface):
-    theme_colors = themes[current_theme]
+# Background layers (gradient, cloud), rendered once per theme and window size
+background_layers = {}
+
+def build_background_layers(theme_name, size):
+    theme_colors = themes[theme_name]
     top_color = theme_colors['gradient_top']
     bottom_color = theme_colors['gradient_bottom']
+    width, height = size
     
-    # Draw gradient
-    for y in range(WINDOW_HEIGHT):
-        ratio = y / WINDOW_HEIGHT
+    # Render the gradient as a single column, then stretch it across the window
+    column = pygame.Surface((1, height))
+    for y in range(height):
+        ratio = y / height
         color = (
             int(top_color[0] * (1 - ratio) + bottom_color[0] * ratio),
             int(top_color[1] * (1 - ratio) + bottom_color[1] * ratio),
             int(top_color[2] * (1 - ratio) + bottom_color[2] * ratio)
         )
-        pygame.draw.line(surface, color, (0, y), (WINDOW_WIDTH, y))
-        
-    # Draw clouds if not galaxy theme
-    if 'Galaxy' not in current_theme:
+        column.set_at((0, y), color)
+    gradient = pygame.transform.scale(column, (width, height)).convert()
+    
+    # No clouds in the galaxy theme
+    cloud = None
+    if 'Galaxy' not in theme_name:
         cloud_color = theme_colors['cloud']
+        # Simple cloud shape, drawn 10px below its top so the raised puff fits
+        cloud = pygame.Surface((120, 50), pygame.SRCALPHA)
+        pygame.draw.ellipse(cloud, cloud_color, (0, 10, 80, 40))
+        pygame.draw.ellipse(cloud, cloud_color, (20, 0, 60, 50))
+        pygame.draw.ellipse(cloud, cloud_color, (50, 10, 70, 40))
+        cloud = cloud.convert_alpha()
+    return gradient, cloud
+
+def invalidate_background():
+    background_layers.clear()
+
+# Background renderer with gradient
+def draw_background(surface):
+    key = (current_theme, (WINDOW_WIDTH, WINDOW_HEIGHT))
+    layers = background_layers.get(key)
+    if layers is None:
+        layers = background_layers[key] = build_background_layers(*key)
+    gradient, cloud = layers
+    surface.blit(gradient, (0, 0))
+        
+    # Drifting clouds
+    if cloud is not None:
         for i in range(3):
             x = 100 + i * 300 + int(math.sin(pygame.time.get_ticks() * 0.0001 + i) * 50)
             y = 50 + i * 40
-            # Simple cloud shape
-            pygame.draw.ellipse(surface, cloud_color, (x, y, 80, 40))
-            pygame.draw.ellipse(surface, cloud_color, (x + 20, y - 10, 60, 50))
-            pygame.draw.ellipse(surface, cloud_color, (x + 50, y, 70, 40))
+            surface.blit(cloud, (x, y - 10))
+
+# Editor grid overlay, rendered once per grid size and viewport
+GRID_ALPHA = 50
+grid_overlays = {}
+
+def build_grid_overlay(cell_size, size):
+    width, height = size
+    overlay = pygame.Surface(size, pygame.SRCALPHA)
+    color = (GRAY[0], GRAY[1], GRAY[2], GRID_ALPHA)
+    for x in range(0, width, cell_size):
+        overlay.fill(color, (x, 0, 1, height))
+    for y in range(0, height, cell_size):
+        overlay.fill(color, (0, y, width, 1))
+    return overlay.convert_alpha()
+
+def draw_grid(surface):
+    key = (GRID_SIZE, (WINDOW_WIDTH, WINDOW_HEIGHT))
+    overlay = grid_overlays.get(key)
+    if overlay is None:
+        overlay = grid_overlays[key] = build_grid_overlay(*key)
+    surface.blit(overlay, (0, 0))
 
 # Helper functions remain the same
 def snap_to_grid(pos, size):
     return (pos[0] // size) * size, (pos[1] // size) * size
 
+def place_entity(pos, tile_type, variant=None):
+    if tile_type in ['ground', 'brick', 'question', 'water', 'pipe']:
+        sprite = Tile(pos, tile_type)
+        tiles_group.add(sprite)
+    elif tile_type == 'enemy':
+        sprite = Enemy(pos, variant or 'goomba')
+        enemies_group.add(sprite)
+    elif tile_type == 'coin':
+        sprite = Coin(pos)
+        coins_group.add(sprite)
+    else:
+        return None
+    all_sprites.add(sprite)
+    cell_index.add(sprite)
+    return sprite
+
 # Save and Load functions (enhanced with theme data)
 def save_level(filename="level.json"):
     level_data = {
@@ -499,6 +832,8 @@ def load_level(filename="level.json"):
             level_data = json.load(file)
             theme = level_data.get("theme", "Mario Forever Classic")
             set_theme(theme)
+            solid_grid.clear()
+            cell_index.clear()
             tiles_group.empty()
             enemies_group.empty()
             coins_group.empty()
@@ -506,20 +841,14 @@ def load_level(filename="level.json"):
             all_sprites.add(player)
             
             for tile_data in level_data["tiles"]:
-                tile = Tile((tile_data["x"], tile_data["y"]), tile_data["type"])
-                tiles_group.add(tile)
-                all_sprites.add(tile)
+                place_entity((tile_data["x"], tile_data["y"]), tile_data["type"])
                 
             for enemy_data in level_data["enemies"]:
                 enemy_type = enemy_data.get("type", "goomba")
-                enemy = Enemy((enemy_data["x"], enemy_data["y"]), enemy_type)
-                enemies_group.add(enemy)
-                all_sprites.add(enemy)
+                place_entity((enemy_data["x"], enemy_data["y"]), 'enemy', enemy_type)
                 
             for coin_data in level_data["coins"]:
-                coin = Coin((coin_data["x"], coin_data["y"]))
-                coins_group.add(coin)
-                all_sprites.add(coin)
+                place_entity((coin_data["x"], coin_data["y"]), 'coin')
         print(f"Level loaded from {filename}")
     except FileNotFoundError:
         print(f"File {filename} not found")
@@ -528,6 +857,7 @@ def set_theme(theme_name):
     global current_theme
     if theme_name in themes:
         current_theme = theme_name
+        invalidate_background()
         # Update all sprites with new theme
         for sprite in all_sprites:
             if hasattr(sprite, 'update_image'):
@@ -541,19 +871,17 @@ def playtest_reset():
     player.coins_collected = 0
     playtest_mode = False
     # Reload coins
-    coins_to_reload = []
     for coin_data in last_saved_coins:
-        coin = Coin((coin_data[0], coin_data[1]))
-        coins_to_reload.append(coin)
-    for coin in coins_to_reload:
-        coins_group.add(coin)
-        all_sprites.add(coin)
+        if cell_index.get(coin_data) is None:
+            place_entity(coin_data, 'coin')
 
 # Initialize sprite groups
 tiles_group = pygame.sprite.Group()
 enemies_group = pygame.sprite.Group()
 coins_group = pygame.sprite.Group()
 all_sprites = pygame.sprite.Group()
+solid_grid = SolidGrid(GRID_SIZE)
+cell_index = CellIndex(GRID_SIZE)
 
 # Create player
 player = Player((100, WINDOW_HEIGHT - GRID_SIZE * 2))
@@ -677,9 +1005,9 @@ main_menu()
 running = True
 mouse_held = False
 erase_mode = False
+sim_accumulator = SIM_TICK_MS
 
 while running:
-    dt = game_clock.tick(FPS) / 1000.0
     
     for event in pygame.event.get():
         if event.type == pygame.QUIT:
@@ -709,17 +1037,20 @@ while running:
                         set_theme(theme_name)
                         
                 if buttons["save"].collidepoint(mouse_pos):
-                    last_saved_coins = [(coin.rect.x, coin.rect.y) for coin in coins_group]
+                    last_saved_coins = [coin.rect.topleft for coin in coins_group]
                     save_level()
                 elif buttons["load"].collidepoint(mouse_pos):
                     load_level()
                 elif buttons["playtest"].collidepoint(mouse_pos):
                     playtest_mode = True
-                    last_saved_coins = [(coin.rect.x, coin.rect.y) for coin in coins_group]
+                    effects_rng.seed(SIM_SEED)
+                    last_saved_coins = [coin.rect.topleft for coin in coins_group]
                     player.rect.center = (100, WINDOW_HEIGHT - GRID_SIZE * 2)
                     player.velocity = pygame.Vector2(0, 0)
                     player.coins_collected = 0
                 elif buttons["clear"].collidepoint(mouse_pos):
+                    solid_grid.clear()
+                    cell_index.clear()
                     tiles_group.empty()
                     enemies_group.empty()
                     coins_group.empty()
@@ -736,69 +1067,48 @@ while running:
             if mouse_pos[1] < WINDOW_HEIGHT:
                 grid_pos = snap_to_grid(mouse_pos, GRID_SIZE)
                 
+                occupant = cell_index.get(grid_pos)
                 if erase_mode:
                     # Erase mode
-                    for sprite in all_sprites:
-                        if sprite.rect.collidepoint(mouse_pos) and sprite != player:
-                            sprite.kill()
-                else:
-                    # Place mode
-                    # Check if position is empty
-                    occupied = False
-                    for sprite in all_sprites:
-                        if sprite.rect.topleft == grid_pos and sprite != player:
-                            occupied = True
-                            break
-                            
-                    if not occupied:
-                        if selected_tile_type in ['ground', 'brick', 'question', 'water', 'pipe']:
-                            tile = Tile(grid_pos, selected_tile_type)
-                            tiles_group.add(tile)
-                            all_sprites.add(tile)
-                        elif selected_tile_type == 'enemy':
-                            enemy = Enemy(grid_pos)
-                            enemies_group.add(enemy)
-                            all_sprites.add(enemy)
-                        elif selected_tile_type == 'coin':
-                            coin = Coin(grid_pos)
-                            coins_group.add(coin)
-                            all_sprites.add(coin)
+                    if occupant is not None:
+                        occupant.kill()
+                elif occupant is None:
+                    # Place mode, only into empty cells
+                    place_entity(grid_pos, selected_tile_type)
     
-    # Update
-    if playtest_mode:
-        solid_tiles = pygame.sprite.Group([tile for tile in tiles_group 
-                                         if tile.tile_type in ['ground', 'brick', 'question', 'water', 'pipe']])
-        player.update(solid_tiles, enemies_group, coins_group)
-        enemies_group.update(solid_tiles)
-        coins_group.update()
-        tiles_group.update()
-    else:
-        # Update animations even in edit mode
-        coins_group.update()
-        tiles_group.update()
-        
-    # Update particles
-    for particle in particles[:]:
-        particle.update()
-        if particle.lifetime <= 0:
-            particles.remove(particle)
+    # Update in fixed ticks, however long the last frame took
+    sim_ticks = 0
+    while sim_accumulator >= SIM_TICK_MS and sim_ticks < MAX_TICKS_PER_FRAME:
+        if playtest_mode:
+            player.update(solid_grid, enemies_group, coins_group)
+            enemies_group.update(solid_grid)
+
+        # Coins and animated tiles read their frame from the shared clock
+        anim_clock.tick()
+
+        # Update particles
+        particles.update()
+
+        sim_accumulator -= SIM_TICK_MS
+        sim_ticks += 1
+    if sim_ticks == MAX_TICKS_PER_FRAME:
+        sim_accumulator = 0  # Too far behind to catch up: slow down instead
     
     # Draw everything
     draw_background(window)
     
     # Draw grid in edit mode
     if not playtest_mode:
-        for x in range(0, WINDOW_WIDTH, GRID_SIZE):
-            pygame.draw.line(window, (GRAY[0], GRAY[1], GRAY[2], 50), (x, 0), (x, WINDOW_HEIGHT), 1)
-        for y in range(0, WINDOW_HEIGHT, GRID_SIZE):
-            pygame.draw.line(window, (GRAY[0], GRAY[1], GRAY[2], 50), (0, y), (WINDOW_WIDTH, y), 1)
+        draw_grid(window)
     
     # Draw sprites
-    all_sprites.draw(window)
+    tiles_group.draw(window)
+    enemies_group.draw(window)
+    draw_coins(window)
+    window.blit(player.image, player.rect)
     
     # Draw particles
-    for particle in particles:
-        particle.draw(window)
+    particles.draw(window)
     
     # Draw HUD
     pygame.draw.rect(window, DARK_GRAY, HUD_RECT)
@@ -854,5 +1164,6 @@ while running:
         window.blit(inst_text, (10, WINDOW_HEIGHT + 95))
     
     pygame.display.flip()
+    sim_accumulator += game_clock.tick(FPS)
 
 pygame.quit()